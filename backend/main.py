@@ -1,14 +1,49 @@
 from fastapi import FastAPI, File, UploadFile, Form
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Body, File, Header, Request, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import cv2
 import numpy as np
 import os
-from typing import List, Tuple
+import asyncio
+import bisect
+import functools
+import hashlib
+import hmac
+import io
+import logging
+import multiprocessing
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, closing
+from typing import List, Optional, Tuple
 import json
+import math
+import sqlite3
+import uuid
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_analysis_pool()
+    SESSIONS.start()
+    JOBS.start()
+    READINESS.start()
+    TEMPLATE_RELOADER.start()
+    yield
+    await TEMPLATE_RELOADER.stop()
+    await READINESS.stop()
+    await JOBS.stop()
+    await SESSIONS.stop()
+    stop_analysis_pool()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 👇 Now it's safe to call this
 app.add_middleware(
@@ -21,7 +56,196 @@ app.add_middleware(
 
 
 # === CONFIG ===
-CARD_TEMPLATES_PATH = "Cards/"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Default paths are relative to this file, not the working directory
+CARD_TEMPLATES_PATH = os.environ.get("BJV_TEMPLATES", os.path.join(BASE_DIR, "Cards"))
+TEMPLATE_CACHE_PATH = os.environ.get("BJV_TEMPLATE_CACHE", os.path.join(BASE_DIR, ".template_cache"))
+TEMPLATE_WATCH_INTERVAL = float(os.environ.get("BJV_TEMPLATE_WATCH_INTERVAL", "2"))  # seconds between template directory checks; 0 = off
+ADMIN_TOKEN = os.environ.get("BJV_ADMIN_TOKEN")  # /admin endpoints require it in X-Admin-Token; unset = loopback clients only
+TEMPLATE_CACHE_VERSION = 5  # Bump whenever TemplateBank preprocessing changes
+TEMPLATE_HEIGHT = 100  # Height templates are resized to on load
+WARP_WIDTH, WARP_HEIGHT = 200, 300  # Size of a perspective-corrected card
+MAX_IMAGE_DIMENSION = int(os.environ.get("BJV_MAX_IMAGE_DIMENSION", "1500"))  # Uploads are downscaled to fit within this many pixels
+DETECTION_MAX_DIMENSION = int(os.environ.get("BJV_DETECTION_MAX_DIMENSION", "640"))  # Edges and contours run on a proxy this big; 0 = full image
+MIN_IMAGE_DIMENSION = 400  # ...and upscaled when either side is smaller than this
+MAX_UPLOAD_BYTES = int(os.environ.get("BJV_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))  # Per image (or live frame)
+MAX_BATCH_BYTES = int(os.environ.get("BJV_MAX_BATCH_BYTES", str(256 * 1024 * 1024)))  # Per /analyze/batch or /jobs request
+MAX_IMAGE_PIXELS = int(os.environ.get("BJV_MAX_IMAGE_PIXELS", str(50_000_000)))  # width * height claimed by the image header
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Uploads are read this much at a time; the image header must fit in the first chunks
+UPLOAD_HEADER_BYTES = 128 * 1024  # Give up looking for image dimensions after this much (JPEG EXIF can precede them)
+COARSE_WIDTH, COARSE_HEIGHT = 20, 30  # Card size for the cheap first matching pass
+MATCH_TOP_K = int(os.environ.get("BJV_MATCH_TOP_K", "8"))  # Templates kept for full scoring; 0 = score all
+MATCH_MODE = os.environ.get("BJV_MATCH_MODE", "full")  # "full", "cascade" (early-exit full), "corner" (rank index) or "descriptor"
+CASCADE_MARGIN = float(os.environ.get("BJV_CASCADE_MARGIN", "0"))  # Stop once the best score beats every remaining bound by this
+CASCADE_NCC_SLACK = 0.05  # Full-resolution NCC exceeds the coarse NCC by at most ~0.045 on real cards
+CORNER_BOX = (0, 0, 56, 60)  # (x, y, width, height) of the rank index in a warped card
+CORNER_SHIFT = 6  # Pixels the rank glyph may be offset from the template's in any direction
+CORNER_SCALE = 0.5  # Corner patches are compared at this scale
+CORNER_CONFIRM = os.environ.get("BJV_CORNER_CONFIRM", "1") == "1"  # Also score the opposite (rotated) corner
+DESCRIPTOR_SIZE = (64, 96)  # (width, height) card planes are resized to for their HOG descriptor
+DESCRIPTOR_APPROXIMATE_MIN = int(os.environ.get("BJV_DESCRIPTOR_APPROXIMATE_MIN", "1000"))  # Templates from which search is approximate
+DESCRIPTOR_NEIGHBOURS = 8  # Templates returned per approximate query
+DESCRIPTOR_CHECKS = 64  # Leaves the approximate (FLANN kd-tree) search visits per query
+ANALYZE_WORKERS = int(os.environ.get("BJV_ANALYZE_WORKERS", os.cpu_count() or 1))  # 0 = run on the thread pool
+ANALYZE_MAX_TASKS_PER_WORKER = int(os.environ.get("BJV_MAX_TASKS_PER_WORKER", "0")) or None  # recycle workers after N tasks
+ANALYSIS_POOL = None
+MAX_IN_FLIGHT = int(os.environ.get("BJV_MAX_IN_FLIGHT", "0")) or 4 * max(ANALYZE_WORKERS, 1)  # Analyses running or queued on the pool
+MAX_BULK_IN_FLIGHT = int(os.environ.get("BJV_MAX_BULK_IN_FLIGHT", "0")) or max(MAX_IN_FLIGHT // 2, 1)  # Of those, batch items and jobs
+ANALYSIS_DEADLINE = float(os.environ.get("BJV_ANALYSIS_DEADLINE", "10"))  # seconds before a request gives up with 504; 0 = none
+QUALITY_TIERS = {  # tier: (in-flight share of MAX_IN_FLIGHT from which it is used, max image dimension, detection max dimension, match mode)
+    "full": (0.0, None, None, None),  # None = the configured value
+    "reduced": (0.5, 1000, 480, "cascade"),
+    "minimal": (0.75, 800, 400, "descriptor"),
+}
+WARMUP_ANALYSES = int(os.environ.get("BJV_WARMUP_ANALYSES", "0")) or 2 * max(ANALYZE_WORKERS, 1)  # Synthetic analyses before /ready
+BATCH_MAX_IMAGES = int(os.environ.get("BJV_BATCH_MAX_IMAGES", "64"))
+JOB_QUEUE_SIZE = int(os.environ.get("BJV_JOB_QUEUE_SIZE", "32"))  # Jobs waiting to run before POST /jobs answers 429
+JOB_QUEUE_BYTES = int(os.environ.get("BJV_JOB_QUEUE_BYTES", str(512 * 1024 * 1024)))  # Image bytes held by queued and running jobs
+JOB_CONCURRENCY = int(os.environ.get("BJV_JOB_CONCURRENCY", "2"))  # Jobs processed at once
+JOB_TTL = float(os.environ.get("BJV_JOB_TTL", "600"))  # seconds a finished job's result is kept
+JOB_MAX_WAIT = 30.0  # Longest long-poll GET /jobs/{id}?wait= may hold a request, in seconds
+LIVE_THUMBNAIL_SIZE = (80, 60)  # (width, height) of the change-detection thumbnail
+TRACK_IOU_THRESHOLD = 0.5  # Bounding-box overlap for a detection to be the same card as in the previous frame
+TRACK_SIGNATURE_SIZE = (12, 18)  # (width, height) of the grayscale patch that tells a tracked card was swapped
+TRACK_CHANGE_THRESHOLD = float(os.environ.get("BJV_TRACK_CHANGE_THRESHOLD", "20"))  # Mean abs signature difference (0-255)
+SESSION_DB_PATH = os.environ.get("BJV_SESSION_DB", os.path.join(BASE_DIR, "table_sessions.sqlite3"))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("BJV_SESSION_FLUSH_INTERVAL", "2"))  # seconds between batched SQLite writes
+SESSION_TTL = float(os.environ.get("BJV_SESSION_TTL", str(12 * 3600)))  # seconds a table session survives without updates
+LIVE_CHANGE_THRESHOLD = float(os.environ.get("BJV_LIVE_CHANGE_THRESHOLD", "3.0"))  # mean abs gray diff
+PIPELINE_VERSION = "3"  # Part of every result cache key; bump when recognition output can change
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("BJV_RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # 0 disables the cache
+RESULT_CACHE_TTL = float(os.environ.get("BJV_RESULT_CACHE_TTL", "300"))  # seconds
+RESULT_CACHE_MODE = os.environ.get("BJV_RESULT_CACHE_MODE", "exact")  # "exact" bytes or "perceptual" near-duplicates
+PERCEPTUAL_THUMBNAIL_SIZE = 48  # perceptual mode compares 48x48 grayscale thumbnails
+PERCEPTUAL_MAX_DIFFERENCE = int(os.environ.get("BJV_PERCEPTUAL_MAX_DIFFERENCE", "20"))  # Largest thumbnail pixel difference of a hit
+
+SHOE_DECKS = int(os.environ.get("BJV_SHOE_DECKS", "6"))  # Decks in the shoe odds are computed against
+DEALER_HITS_SOFT_17 = os.environ.get("BJV_DEALER_HITS_SOFT_17", "0") == "1"
+ODDS_CACHE_SIZE = int(os.environ.get("BJV_ODDS_CACHE_SIZE", "4096"))  # Memoized dealer distributions / strategy tables
+ODDS_MAX_HANDS = 10000  # Hands per /odds request
+# Per-request odds against a fresh shoe minus the dealer's cards (precomputed tables); "1" = minus every card
+# on the table, exact but a new strategy table (milliseconds) for almost every table state
+ODDS_EXACT = os.environ.get("BJV_ODDS_EXACT", "0") == "1"
+LOG_LEVEL = os.environ.get("BJV_LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("blackjack_vision")
+
+# === Metrics ===
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class StageTimings(dict):
+    """Seconds spent per pipeline stage for one analysis, accumulated across repeated stages"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.templates_evaluated = []  # Templates fully scored per matched card
+
+    def lap(self, stage: str, since: float) -> float:
+        """Add the time elapsed since `since` to `stage` and return the current clock"""
+        now = time.perf_counter()
+        self[stage] = self.get(stage, 0.0) + (now - since)
+        return now
+
+def format_labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Prometheus counter with a fixed set of label names"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus histogram with a fixed set of label names"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [per-bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                # One count per bucket plus an overflow slot for +Inf
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        with self.lock:
+            for labelvalues, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, bound)} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+class Gauge:
+    """Prometheus gauge whose value is read from a callback at scrape time"""
+
+    def __init__(self, name: str, documentation: str, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self.function()}"]
+
+STAGE_SECONDS = Histogram("bjv_stage_seconds", "Time spent in each analysis pipeline stage", ("stage",))
+REQUEST_SECONDS = Histogram("bjv_request_seconds", "End-to-end analysis request time", ("endpoint",))
+REQUESTS_TOTAL = Counter("bjv_requests_total", "Analysis requests by endpoint and status", ("endpoint", "status"))
+TEMPLATES_EVALUATED = Histogram("bjv_templates_evaluated", "Templates fully scored per matched card", (),
+                                (1, 2, 4, 8, 16, 32, 64, 128))
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, TEMPLATES_EVALUATED]
+
+def record_stage_timings(timings: dict):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage)
+    for count in getattr(timings, "templates_evaluated", ()):
+        TEMPLATES_EVALUATED.observe(count)
+
+def record_request(endpoint: str, status: int, start: float):
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+    REQUESTS_TOTAL.inc(endpoint, str(status))
+
+def server_timing_header(timings: dict, total: float) -> str:
+    """Server-Timing header value, durations in milliseconds"""
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
 # === Load templates ===
 def load_templates() -> List[Tuple[str, np.ndarray]]:
@@ -30,9 +254,12 @@ def load_templates() -> List[Tuple[str, np.ndarray]]:
         if file.endswith(".png"):
             name = file.replace(".png", "").replace("_of_", " ").title()
             template = cv2.imread(os.path.join(CARD_TEMPLATES_PATH, file), cv2.IMREAD_COLOR)
+            if template is None:
+                logger.warning("skipping unreadable template file=%s", file)
+                continue
             
             # Resize templates to a more reasonable size for matching
-            target_height = 100
+            target_height = TEMPLATE_HEIGHT
             scale = target_height / template.shape[0]
             target_width = int(template.shape[1] * scale)
             template_resized = cv2.resize(template, (target_width, target_height))
@@ -40,9 +267,6 @@ def load_templates() -> List[Tuple[str, np.ndarray]]:
             templates.append((name, template_resized))
     return templates
 
-TEMPLATES = load_templates()
-print(f"Loaded {len(TEMPLATES)} card templates")
-
 # === Helper functions from notebook ===
 def order_points(pts):
     """Order points for perspective transform: top-left, top-right, bottom-right, bottom-left"""
@@ -55,7 +279,7 @@ def order_points(pts):
     rect[3] = pts[np.argmax(diff)]  # bottom-left
     return rect
 
-def four_point_transform(image, pts, width=200, height=300):
+def four_point_transform(image, pts, width=WARP_WIDTH, height=WARP_HEIGHT):
     """Perspective transform to get bird's-eye view of card"""
     rect = order_points(pts)
     dst = np.array([
@@ -72,6 +296,68 @@ def get_leftmost_x(contour):
     pts = contour.reshape(-1, 2)
     return np.min(pts[:, 0])
 
+def prefilter_contours(contours, min_area: float) -> np.ndarray:
+    """
+    Indices of the contours that can still pass the card checks, decided for all
+    contours at once from their point counts and bounding boxes (one reduceat
+    over the concatenated points): fewer than 4 points cannot approximate a
+    quadrilateral, a contour's area never exceeds its bounding box, and the
+    aspect ratio check is the same one detection applies.
+    """
+    if len(contours) == 0:
+        return np.zeros(0, dtype=np.intp)
+    counts = np.fromiter((len(c) for c in contours), dtype=np.intp, count=len(contours))
+    points = np.concatenate(contours).reshape(-1, 2)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    # Same width/height as cv2.boundingRect on integer points
+    widths, heights = (np.maximum.reduceat(points, starts) - np.minimum.reduceat(points, starts) + 1).T
+    aspect = widths / heights
+    keep = (counts >= 4) & (widths * heights > min_area) & (aspect >= 0.5) & (aspect <= 2.0)
+    return np.flatnonzero(keep)
+
+def detection_proxy(gray: np.ndarray, max_dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Copy of a grayscale image downscaled to fit within max_dimension for edge and
+    contour detection, plus the per-axis (x, y) factors mapping proxy coordinates back.
+    Bilinear is enough here since detection blurs the proxy anyway, and is several
+    times cheaper than INTER_AREA at non-integer factors.
+    """
+    height, width = gray.shape[:2]
+    if max_dimension <= 0 or max(height, width) <= max_dimension:
+        return gray, np.ones(2, dtype=np.float32)
+    factor = max_dimension / max(height, width)
+    proxy = cv2.resize(gray, (max(round(width * factor), 1), max(round(height * factor), 1)), interpolation=cv2.INTER_LINEAR)
+    return proxy, np.array([width / proxy.shape[1], height / proxy.shape[0]], dtype=np.float32)
+
+def contour_centroid(contour) -> Tuple[int, int]:
+    """Centroid from the contour's moments, or its bounding-box center for degenerate contours"""
+    M = cv2.moments(contour)
+    if M["m00"] != 0:
+        return int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])
+    x, y, w, h = cv2.boundingRect(contour)
+    return x + w // 2, y + h // 2
+
+def gradient_map(gray_img):
+    """Sobel gradient magnitude normalized to [0, 1]"""
+    grad_x = cv2.Sobel(gray_img, cv2.CV_64F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(gray_img, cv2.CV_64F, 0, 1, ksize=3)
+    grad = np.sqrt(grad_x**2 + grad_y**2)
+    grad /= (np.max(grad) + 1e-8)
+    return grad
+
+def normalized_histogram(gray_img):
+    """256-bin intensity histogram normalized to sum to 1"""
+    hist = cv2.calcHist([gray_img], [0], None, [256], [0, 256])
+    hist /= (np.sum(hist) + 1e-8)
+    return hist
+
+def ncc_vector(gray_img):
+    """Zero-mean, unit-norm flattened image so TM_CCOEFF_NORMED becomes a dot product"""
+    vec = gray_img.astype(np.float64).ravel()
+    vec -= vec.mean()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 1e-8 else vec
+
 def combined_card_score(card_img, template_img):
     """Multi-metric scoring like in notebook"""
     # Ensure both are grayscale
@@ -85,229 +371,567 @@ def combined_card_score(card_img, template_img):
     corr = max(0, result[0, 0])
     
     # Structural similarity (simplified)
-    card_grad_x = cv2.Sobel(card_img, cv2.CV_64F, 1, 0, ksize=3)
-    card_grad_y = cv2.Sobel(card_img, cv2.CV_64F, 0, 1, ksize=3)
-    card_grad = np.sqrt(card_grad_x**2 + card_grad_y**2)
-    card_grad /= (np.max(card_grad) + 1e-8)
-    
-    template_grad_x = cv2.Sobel(template_img, cv2.CV_64F, 1, 0, ksize=3)
-    template_grad_y = cv2.Sobel(template_img, cv2.CV_64F, 0, 1, ksize=3)
-    template_grad = np.sqrt(template_grad_x**2 + template_grad_y**2)
-    template_grad /= (np.max(template_grad) + 1e-8)
-    
-    diff = np.abs(card_grad - template_grad)
+    diff = np.abs(gradient_map(card_img) - gradient_map(template_img))
     struct = max(0, 1 - np.mean(diff))
     
     # Histogram correlation
-    hist1 = cv2.calcHist([card_img], [0], None, [256], [0, 256])
-    hist2 = cv2.calcHist([template_img], [0], None, [256], [0, 256])
-    hist1 /= (np.sum(hist1) + 1e-8)
-    hist2 /= (np.sum(hist2) + 1e-8)
-    hist = max(0, cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL))
+    hist = max(0, cv2.compareHist(normalized_histogram(card_img), normalized_histogram(template_img), cv2.HISTCMP_CORREL))
     
     # Combined score (50% correlation, 30% structural, 20% histogram)
     combined = 0.5 * corr + 0.3 * struct + 0.2 * hist
     return combined
 
-def detect_and_classify_cards(image: np.ndarray, players: int = 1) -> tuple:
+# === Template feature bank ===
+def corner_patch(plane, inset=0):
+    """Rank index (CORNER_BOX shrunk by inset on every side) at CORNER_SCALE, as float32"""
+    x, y, w, h = CORNER_BOX
+    patch = plane[y + inset:y + h - inset, x + inset:x + w - inset]
+    return cv2.resize(patch, None, fx=CORNER_SCALE, fy=CORNER_SCALE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def normalize_rows(rows):
+    """Zero-mean, unit-norm rows (ncc_vector for a whole stack at once)"""
+    rows = rows - rows.mean(axis=-1, keepdims=True)
+    return rows / (np.linalg.norm(rows, axis=-1, keepdims=True) + 1e-8)
+
+HOG = cv2.HOGDescriptor(DESCRIPTOR_SIZE, (16, 16), (8, 8), (8, 8), 9)
+
+def card_descriptor(plane):
+    """Unit-length HOG descriptor of a card plane, so cosine similarity is a dot product"""
+    vec = HOG.compute(cv2.resize(plane, DESCRIPTOR_SIZE, interpolation=cv2.INTER_AREA)).ravel()
+    return vec / (np.linalg.norm(vec) + 1e-8)
+
+def coarse_plane(plane):
+    """Area-downsampled card plane for the cheap first matching pass"""
+    return cv2.resize(plane, (COARSE_WIDTH, COARSE_HEIGHT), interpolation=cv2.INTER_AREA)
+
+def correlation_vector(hist):
+    """Zero-mean, unit-norm histogram so HISTCMP_CORREL becomes a dot product"""
+    vec = np.asarray(hist, dtype=np.float64).ravel()
+    vec = vec - vec.mean()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 1e-8 else vec
+
+class TemplateBank:
+    """
+    Template-side matching features, computed once from load_templates().
+    Each template is resized to the warped card size and blurred exactly as
+    match_cards_to_templates used to do per call, then its features are
+    stacked into contiguous float32 tensors (one row per template) so a batch
+    of cards is scored against every template with a few matrix operations.
+    """
+
+    # Feature tensors persisted by save() and memory-mapped back by load()
+    ARRAYS = (
+        "planes", "gradients", "gradient_means", "histograms", "ncc_vectors", "hist_vectors", "coarse_vectors",
+        "corner_vectors", "descriptors",
+    )
+
+    def __init__(self, templates: List[Tuple[str, np.ndarray]], width: int = WARP_WIDTH, height: int = WARP_HEIGHT):
+        self.width = width
+        self.height = height
+        self.names = []
+        self.template_shapes = []  # shape of each template as loaded, for /debug/templates
+
+        planes, gradients, histograms = [], [], []
+        for name, template in templates:
+            template_resized = cv2.resize(template, (width, height))
+            template_blurred = cv2.GaussianBlur(template_resized, (3, 3), 0)
+            plane = cv2.cvtColor(template_blurred, cv2.COLOR_BGR2GRAY) if template_blurred.ndim == 3 else template_blurred
+
+            self.names.append(name)
+            self.template_shapes.append(list(template.shape))
+            planes.append(plane)
+            gradients.append(gradient_map(plane).ravel())
+            histograms.append(normalized_histogram(plane).ravel())
+
+        pixels = width * height
+        self.planes = np.stack(planes) if planes else np.zeros((0, height, width), np.uint8)  # (T, H, W) blurred grayscale
+        self.gradients = np.array(gradients, dtype=np.float32).reshape(-1, pixels)  # (T, H*W) normalized Sobel magnitude
+        self.gradient_means = self.gradients.mean(axis=1)  # (T,) for the cascade's structure bound
+        self.histograms = np.array(histograms, dtype=np.float32).reshape(-1, 256)  # (T, 256) normalized histogram
+        self.ncc_vectors = np.array([ncc_vector(p) for p in planes], dtype=np.float32).reshape(-1, pixels)  # (T, H*W)
+        self.hist_vectors = np.array([correlation_vector(h) for h in histograms], dtype=np.float32).reshape(-1, 256)  # (T, 256)
+        self.coarse_vectors = np.array([ncc_vector(coarse_plane(p)) for p in planes], dtype=np.float32).reshape(-1, COARSE_WIDTH * COARSE_HEIGHT)
+        # Rank glyphs, inset by CORNER_SHIFT so cards can be searched around them
+        corners = [corner_patch(p, CORNER_SHIFT) for p in planes]
+        self.corner_vectors = normalize_rows(np.array(corners, dtype=np.float32).reshape(len(corners), -1))  # (T, h*w)
+        self.descriptors = np.array([card_descriptor(p) for p in planes], dtype=np.float32).reshape(len(planes), HOG.getDescriptorSize())
+        self._build_rank_index()
+
+    def _build_rank_index(self):
+        self.ranks = [name.split()[0] for name in self.names]  # "Ace", "King", etc.
+        self.rank_indices = {}  # rank -> indices of its template variants
+        for idx, rank_name in enumerate(self.ranks):
+            self.rank_indices.setdefault(rank_name, []).append(idx)
+
+        self._descriptor_index = None  # FLANN index over descriptors, built on first approximate query
+        self.version = None  # cache key, set by load_template_bank()
+
+        # Column permutation grouping variants by rank, for per-rank max via reduceat
+        self.rank_names = list(self.rank_indices)
+        self._rank_perm = np.array([idx for rank in self.rank_names for idx in self.rank_indices[rank]], dtype=np.intp)
+        self._rank_starts = np.cumsum([0] + [len(self.rank_indices[rank]) for rank in self.rank_names[:-1]]).astype(np.intp)
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self, path: str):
+        """Write the bank as one .npy per tensor plus meta.json; the directory appears atomically"""
+        path = path.rstrip("/")
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for attr in self.ARRAYS:
+            np.save(os.path.join(tmp_path, f"{attr}.npy"), np.ascontiguousarray(getattr(self, attr)))
+        meta = {
+            "version": TEMPLATE_CACHE_VERSION,
+            "width": self.width,
+            "height": self.height,
+            "names": self.names,
+            "template_shapes": self.template_shapes,
+        }
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another worker published the same cache entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> "TemplateBank":
+        """Memory-map a bank written by save(), so worker processes share its pages"""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != TEMPLATE_CACHE_VERSION:
+            raise ValueError(f"Template cache version {meta.get('version')} != {TEMPLATE_CACHE_VERSION}")
+
+        bank = cls.__new__(cls)
+        bank.width = meta["width"]
+        bank.height = meta["height"]
+        bank.names = meta["names"]
+        bank.template_shapes = meta["template_shapes"]
+        for attr in cls.ARRAYS:
+            array = np.load(os.path.join(path, f"{attr}.npy"), mmap_mode="r")
+            if len(array) != len(bank.names):
+                raise ValueError(f"Template cache entry {attr}.npy has {len(array)} rows, expected {len(bank.names)}")
+            setattr(bank, attr, np.asarray(array))
+        bank._build_rank_index()
+        return bank
+
+    def card_plane(self, card: np.ndarray) -> np.ndarray:
+        """Grayscale + blur a warped card the same way the templates were prepared"""
+        card_gray = cv2.cvtColor(card, cv2.COLOR_BGR2GRAY) if card.ndim == 3 else card
+        if card_gray.shape[:2] != (self.height, self.width):
+            card_gray = cv2.resize(card_gray, (self.width, self.height))
+        return cv2.GaussianBlur(card_gray, (3, 3), 0)
+
+    @property
+    def corner_shape(self) -> Tuple[int, int]:
+        """(h, w) of the stored template glyphs"""
+        return corner_patch(np.zeros((self.height, self.width), np.uint8), CORNER_SHIFT).shape
+
+    def corner_scores(self, plane: np.ndarray) -> np.ndarray:
+        """Best NCC of the plane's rank index against every template glyph over all shifts up to CORNER_SHIFT"""
+        h, w = self.corner_shape
+        windows = np.lib.stride_tricks.sliding_window_view(corner_patch(plane), (h, w)).reshape(-1, h * w)
+        return (normalize_rows(windows) @ self.corner_vectors.T).max(axis=0)
+
+    def card_features(self, cards: List[np.ndarray]) -> tuple:
+        """(ncc, gradient, histogram, coarse ncc) feature rows for a batch of warped cards"""
+        planes = [self.card_plane(card) for card in cards]
+        ncc = np.array([ncc_vector(p) for p in planes], dtype=np.float32)
+        grads = np.array([gradient_map(p).ravel() for p in planes], dtype=np.float32)
+        hists = np.array([correlation_vector(normalized_histogram(p)) for p in planes], dtype=np.float32)
+        coarse = np.array([ncc_vector(coarse_plane(p)) for p in planes], dtype=np.float32)
+        return ncc, grads, hists, coarse
+
+    def score_cards(self, cards: List[np.ndarray], top_k: int = 0) -> np.ndarray:
+        """
+        Combined score of every card against every template, shape (cards, templates).
+        Same 0.5/0.3/0.2 combination as combined_card_score: correlation and
+        histogram terms are single matrix products, the gradient term is one
+        broadcast L1 distance per card.
+
+        With top_k > 0 a cheap first pass (low-resolution NCC plus the histogram
+        term) keeps only the top_k templates per card for full scoring; the
+        others get a score of -1.
+        """
+        if len(cards) == 0 or len(self) == 0:
+            return np.zeros((len(cards), len(self)), dtype=np.float32)
+        ncc, grads, hists, coarse = self.card_features(cards)
+
+        if 0 < top_k < len(self):
+            hist = np.maximum(hists @ self.hist_vectors.T, 0)
+            coarse_scores = 0.5 * np.maximum(coarse @ self.coarse_vectors.T, 0) + 0.2 * hist
+            candidates = np.argpartition(-coarse_scores, top_k - 1, axis=1)[:, :top_k]
+
+            scores = np.full((len(cards), len(self)), -1, dtype=np.float32)
+            for i, idx in enumerate(candidates):
+                corr = np.maximum(self.ncc_vectors[idx] @ ncc[i], 0)
+                struct = np.maximum(1 - np.abs(self.gradients[idx] - grads[i]).mean(axis=1), 0)
+                scores[i, idx] = 0.5 * corr + 0.3 * struct + 0.2 * hist[i, idx]
+            return scores
+
+        corr = np.maximum(ncc @ self.ncc_vectors.T, 0)
+        hist = np.maximum(hists @ self.hist_vectors.T, 0)
+        struct = np.empty_like(corr)
+        for i, grad in enumerate(grads):
+            struct[i] = np.abs(self.gradients - grad).mean(axis=1)
+        struct = np.maximum(1 - struct, 0)
+
+        return 0.5 * corr + 0.3 * struct + 0.2 * hist
+
+    def score_cascade(self, cards: List[np.ndarray], priors: List[Optional[str]] = None,
+                      margin: float = CASCADE_MARGIN) -> Tuple[np.ndarray, List[int]]:
+        """
+        Early-exit version of score_cards. Every template gets a cheap upper bound
+        on its full score (coarse NCC plus CASCADE_NCC_SLACK, the gradient-mean
+        difference, the exact histogram term). Templates are then fully scored
+        one at a time, variants of the card's prior rank first and the rest by
+        descending bound, until the best score beats the highest bound still
+        unscored by margin. Unscored templates get -1.
+        Returns (scores, number of templates scored per card).
+        """
+        if len(cards) == 0 or len(self) == 0:
+            return np.zeros((len(cards), len(self)), dtype=np.float32), [0] * len(cards)
+        ncc, grads, hists, coarse = self.card_features(cards)
+        hist = np.maximum(hists @ self.hist_vectors.T, 0)
+        corr_bound = np.minimum(np.maximum(coarse @ self.coarse_vectors.T, 0) + CASCADE_NCC_SLACK, 1)
+        struct_bound = np.maximum(1 - np.abs(grads.mean(axis=1)[:, None] - self.gradient_means), 0)
+        bounds = 0.5 * corr_bound + 0.3 * struct_bound + 0.2 * hist
+
+        scores = np.full((len(cards), len(self)), -1, dtype=np.float32)
+        evaluated = []
+        for i in range(len(cards)):
+            order = np.argsort(-bounds[i], kind="stable")
+            prior = priors[i] if priors and i < len(priors) else None
+            if prior in self.rank_indices:
+                first = np.isin(order, self.rank_indices[prior])
+                order = np.concatenate([order[first], order[~first]])
+            # Highest bound among the templates from position n onwards
+            remaining = np.append(np.maximum.accumulate(bounds[i, order][::-1])[::-1], -np.inf)
+
+            best = -1.0
+            for n, idx in enumerate(order):
+                corr = max(float(self.ncc_vectors[idx] @ ncc[i]), 0)
+                struct = max(1 - float(np.abs(self.gradients[idx] - grads[i]).mean()), 0)
+                scores[i, idx] = 0.5 * corr + 0.3 * struct + 0.2 * hist[i, idx]
+                best = max(best, float(scores[i, idx]))
+                if best - remaining[n + 1] >= margin:
+                    break
+            evaluated.append(n + 1)
+        return scores, evaluated
+
+    def descriptor_index(self):
+        """FLANN kd-tree over the template descriptors (squared L2, which ranks like cosine for unit vectors)"""
+        if self._descriptor_index is None:
+            self._descriptor_features = np.array(self.descriptors, dtype=np.float32)  # FLANN keeps a pointer to it
+            self._descriptor_index = cv2.flann_Index(self._descriptor_features, dict(algorithm=1, trees=4))
+        return self._descriptor_index
+
+    def score_descriptors(self, cards: List[np.ndarray], approximate: bool = None) -> Tuple[np.ndarray, List[int]]:
+        """
+        Cosine similarity between each card's HOG descriptor and the template
+        descriptors: one matrix product, or with approximate (default: at least
+        DESCRIPTOR_APPROXIMATE_MIN templates) a FLANN query that scores only the
+        DESCRIPTOR_NEIGHBOURS nearest templates, the others get -1.
+        Returns (scores, number of templates compared per card).
+        """
+        if len(cards) == 0 or len(self) == 0:
+            return np.zeros((len(cards), len(self)), dtype=np.float32), [0] * len(cards)
+        queries = np.array([card_descriptor(self.card_plane(card)) for card in cards], dtype=np.float32)
+        if approximate is None:
+            approximate = len(self) >= DESCRIPTOR_APPROXIMATE_MIN
+        if not approximate:
+            return np.maximum(queries @ self.descriptors.T, 0), [len(self)] * len(cards)
+
+        neighbours = min(DESCRIPTOR_NEIGHBOURS, len(self))
+        indices, distances = self.descriptor_index().knnSearch(queries, neighbours, params=dict(checks=DESCRIPTOR_CHECKS))
+        scores = np.full((len(cards), len(self)), -1, dtype=np.float32)
+        np.put_along_axis(scores, indices.astype(np.intp), np.maximum(1 - distances / 2, 0), axis=1)
+        return scores, [neighbours] * len(cards)
+
+    def score_corners(self, cards: List[np.ndarray], confirm: bool = True) -> np.ndarray:
+        """
+        Score cards on the rank index alone (CORNER_BOX, about 1/18 of the card).
+        With confirm, the opposite corner (bottom-right, rotated 180 degrees) is
+        scored too and each template keeps the better of the two, so a card whose
+        index is covered on one corner is still recognized from the other.
+        """
+        if len(cards) == 0 or len(self) == 0:
+            return np.zeros((len(cards), len(self)), dtype=np.float32)
+        planes = [self.card_plane(card) for card in cards]
+        scores = np.array([self.corner_scores(p) for p in planes])
+        if confirm:
+            opposite = np.array([self.corner_scores(np.rot90(p, 2)) for p in planes])
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, agree in enumerate(np.argmax(scores, axis=1) == np.argmax(opposite, axis=1)):
+                    logger.debug("card=%d corners_agree=%s", i + 1, bool(agree))
+            scores = np.maximum(scores, opposite)
+        return np.maximum(scores, 0)
+
+    def best_per_rank(self, scores: np.ndarray) -> np.ndarray:
+        """Reduce (cards, templates) scores to (cards, ranks) by taking the best variant per rank"""
+        return np.maximum.reduceat(scores[:, self._rank_perm], self._rank_starts, axis=1)
+
+def template_cache_key(templates_path: str = CARD_TEMPLATES_PATH) -> str:
+    """Hash of the template images and every parameter that shapes the bank"""
+    digest = hashlib.sha256()
+    params = {
+        "version": TEMPLATE_CACHE_VERSION,
+        "template_height": TEMPLATE_HEIGHT,
+        "warp_size": [WARP_WIDTH, WARP_HEIGHT],
+        "coarse_size": [COARSE_WIDTH, COARSE_HEIGHT],
+        "corner": [list(CORNER_BOX), CORNER_SHIFT, CORNER_SCALE],
+        "descriptor_size": list(DESCRIPTOR_SIZE),
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for file in sorted(os.listdir(templates_path)):
+        if file.endswith(".png"):
+            digest.update(file.encode())
+            with open(os.path.join(templates_path, file), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def load_template_bank() -> TemplateBank:
+    """
+    Load the template bank from the on-disk cache, building and caching it on a miss.
+    bank.version is its cache key, i.e. a hash of the template images and parameters.
+    """
+    version = template_cache_key()
+    cache_dir = os.path.join(TEMPLATE_CACHE_PATH, version)
+    if os.path.isdir(cache_dir):
+        try:
+            bank = TemplateBank.load(cache_dir)
+            bank.version = version
+            logger.info("templates loaded count=%d cache=%s", len(bank), cache_dir)
+            return bank
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("ignoring unreadable template cache=%s error=%s", cache_dir, e)
+
+    bank = TemplateBank(load_templates())
+    bank.version = version
+    logger.info("templates loaded count=%d version=%s", len(bank), version)
+    try:
+        os.makedirs(TEMPLATE_CACHE_PATH, exist_ok=True)
+        bank.save(cache_dir)
+    except OSError as e:
+        logger.warning("could not write template cache=%s error=%s", cache_dir, e)
+    return bank
+
+_template_bank = None
+_template_bank_generation = 0  # Bumped by every hot reload in the server process
+
+def get_template_bank() -> TemplateBank:
+    """The process-wide template bank, loaded on first use (once per analysis worker)"""
+    global _template_bank
+    if _template_bank is None:
+        _template_bank = load_template_bank()
+    return _template_bank
+
+def set_template_bank(bank: TemplateBank, generation: int):
+    """Swap in another bank; analyses that already fetched the old one finish with it"""
+    global _template_bank, _template_bank_generation
+    _template_bank, _template_bank_generation = bank, generation
+
+def template_bank_version() -> Optional[str]:
+    return _template_bank.version if _template_bank is not None else None
+
+def with_template_bank(generation: int, version: str, func, *args):
+    """
+    Pool task wrapper: before running func, switch this worker to bank 'version' if the
+    server has swapped in a newer bank (generation) than the worker has. The server
+    already wrote that version to the template cache, so this is a memory-mapped load.
+    """
+    if generation > _template_bank_generation:
+        try:
+            bank = TemplateBank.load(os.path.join(TEMPLATE_CACHE_PATH, version))
+            bank.version = version
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("template cache missing version=%s error=%s, rebuilding", version, e)
+            bank = load_template_bank()
+        set_template_bank(bank, generation)
+        logger.info("template bank switched version=%s generation=%d", bank.version, generation)
+    return func(*args)
+
+# === Card detection ===
+REGIONS = ("dealer", "player1", "player2")
+PLAYER_COUNTS = (1, 2)  # Supported table layouts: dealer plus one or two players
+PLAYERS_ERROR = "players must be 1 or 2"
+
+class DetectedCard:
+    """
+    One detected card as compact geometry in full image coordinates. The
+    WARP_WIDTH x WARP_HEIGHT warp is only produced on demand, by warp().
+    """
+    __slots__ = ("quad", "centroid", "area", "region", "bbox")
+
+    def __init__(self, quad: np.ndarray, centroid: Tuple[int, int], area: float, region: str, bbox: Tuple[int, int, int, int]):
+        self.quad = quad  # (4, 2) float32 corner points
+        self.centroid = centroid  # (x, y)
+        self.area = area  # contour area in pixels
+        self.region = region  # "dealer", "player1" or "player2"
+        self.bbox = bbox  # (x, y, w, h)
+
+    def __repr__(self):
+        return f"DetectedCard(region={self.region!r}, bbox={self.bbox}, area={self.area:.0f})"
+
+    def warp(self, image: np.ndarray) -> np.ndarray:
+        """Perspective-corrected BGR card cut from image"""
+        return four_point_transform(image, self.quad)
+
+def detect_and_classify_cards(image: np.ndarray, players: int = 1, timings: "StageTimings" = None,
+                              detection_size: int = None) -> List[DetectedCard]:
     """
     Detect cards using contour detection like in the notebook.
-    Returns (dealer_cards, player1_cards, player2_cards)
+    Contours are found on a proxy of at most detection_size pixels (default
+    DETECTION_MAX_DIMENSION); the returned records are in full image coordinates,
+    grouped dealer, player1, player2 and left to right within each region.
+    Nothing is warped here, see warp_cards.
     """
-    print(f"Starting card detection on image shape: {image.shape}")
+    timings = timings if timings is not None else StageTimings()
+    logger.debug("detection start shape=%s", image.shape)
+    start = time.perf_counter()
     
-    # 1. Preprocessing (following notebook)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # 1. Preprocessing (following notebook), on the detection proxy
+    gray, scale = detection_proxy(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
+                                  DETECTION_MAX_DIMENSION if detection_size is None else detection_size)
+    logger.debug("detection proxy shape=%s", gray.shape)
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     edges = cv2.Canny(blurred, 50, 150)
+    start = timings.lap("edges", start)
     
     # 2. Find contours
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    print(f"Found {len(contours)} total contours")
+    logger.debug("contours found=%d", len(contours))
     
     # 3. Filter for card-like contours (quadrilaterals with large area)
-    card_contours = []
-    min_area = 5000  # Reduced from 10000
+    card_contours = []  # (approximated polygon, centroid, area), in full image coordinates
+    min_area = 5000 / (scale[0] * scale[1])  # Reduced from 10000; 5000 full-image pixels on the proxy
+    
+    # Bulk pass on point counts and bounding boxes (which also covers the card-like
+    # aspect ratio check), so clutter never reaches the per-contour calls below
+    candidates = prefilter_contours(contours, min_area)
+    logger.debug("contour candidates=%d rejected=%d", len(candidates), len(contours) - len(candidates))
     
-    for i, cnt in enumerate(contours):
+    for i in candidates:
+        cnt = contours[i]
         area = cv2.contourArea(cnt)
+        if area <= min_area:
+            logger.debug("contour index=%d rejected=area area=%.0f", i, area)
+            continue
+        
         peri = cv2.arcLength(cnt, True)
         approx = cv2.approxPolyDP(cnt, 0.02 * peri, True)
-        
-        print(f"Contour {i}: area={area:.0f}, vertices={len(approx)}")
-        
-        # More flexible criteria
-        if len(approx) >= 4 and area > min_area:  # Changed from == 4 to >= 4
-            # Additional check: aspect ratio should be card-like
-            x, y, w, h = cv2.boundingRect(cnt)
-            aspect_ratio = w / h if h > 0 else 0
-            
-            # Cards typically have aspect ratio between 0.6 and 1.8
-            if 0.5 <= aspect_ratio <= 2.0:
-                card_contours.append(approx)
-                print(f"  → Added as card contour (aspect ratio: {aspect_ratio:.2f})")
-            else:
-                print(f"  → Rejected: bad aspect ratio {aspect_ratio:.2f}")
+        if len(approx) >= 4:  # Changed from == 4 to >= 4
+            cX, cY = contour_centroid(approx)
+            card_contours.append((approx.astype(np.float32) * scale, (int(cX * scale[0]), int(cY * scale[1])),
+                                  area * scale[0] * scale[1]))
+            logger.debug("contour index=%d accepted area=%.0f vertices=%d", i, area, len(approx))
         else:
-            if area <= min_area:
-                print(f"  → Rejected: area too small")
-            else:
-                print(f"  → Rejected: not enough vertices")
+            logger.debug("contour index=%d rejected=vertices vertices=%d", i, len(approx))
     
-    print(f"Found {len(card_contours)} card-like contours")
+    logger.debug("card contours found=%d", len(card_contours))
     
     if len(card_contours) == 0:
-        print("No card contours detected!")
-        return [], [], []
+        timings.lap("contours", start)
+        logger.info("no card contours detected")
+        return []
     
-    # 4. Classify contours into dealer vs player(s)
-    h, w = image.shape[:2]
-    dealer_contours = []
-    player_contours = []
-    
-    for cnt in card_contours:
-        # Calculate centroid
-        M = cv2.moments(cnt)
-        if M["m00"] != 0:
-            cY = int(M["m01"] / M["m00"])
+    # 4. Classify contours into dealer vs player(s); two players split the
+    # bottom half at the middle, player 1 on the right
+    image_h, image_w = image.shape[:2]
+    cards = []
+    for cnt, (cX, cY), area in card_contours:
+        if cY < image_h / 2:
+            region = "dealer"
+        elif players == 2 and cX < image_w / 2:
+            region = "player2"
         else:
-            x, y, ww, hh = cv2.boundingRect(cnt)
-            cY = y + hh // 2
+            region = "player1"
+        logger.debug("contour region=%s cX=%d cY=%d", region, cX, cY)
         
-        if cY < h / 2:
-            dealer_contours.append(cnt)
-            print(f"Classified contour as dealer (cY={cY} < {h/2})")
+        # Exactly 4 points are the card's corners, otherwise use the bounding rectangle
+        x, y, w, h = cv2.boundingRect(cnt)
+        if len(cnt) == 4:
+            quad = cnt.reshape(4, 2)
         else:
-            player_contours.append(cnt)
-            print(f"Classified contour as player (cY={cY} >= {h/2})")
-    
-    # Sort by x position (left to right)
-    dealer_contours = sorted(dealer_contours, key=get_leftmost_x)
-    player_contours = sorted(player_contours, key=get_leftmost_x)
+            quad = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], dtype=np.float32)
+        cards.append(DetectedCard(quad, (cX, cY), area, region, (x, y, w, h)))
     
-    print(f"Classified: {len(dealer_contours)} dealer, {len(player_contours)} player contours")
+    # Sort by region, then by x position (left to right)
+    cards.sort(key=lambda card: (REGIONS.index(card.region), get_leftmost_x(card.quad)))
     
-    # 5. Extract and warp cards
-    dealer_cards = []
-    for i, cnt in enumerate(dealer_contours):
+    timings.lap("contours", start)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("classified %s", " ".join(f"{region}={sum(c.region == region for c in cards)}" for region in REGIONS))
+    return cards
+
+def warp_cards(image: np.ndarray, cards: List[DetectedCard], timings: "StageTimings" = None) -> List[Optional[np.ndarray]]:
+    """Warp only the given detections, in order; None for a card whose warp failed"""
+    start = time.perf_counter()
+    warped = []
+    for i, card in enumerate(cards):
         try:
-            # For debugging, let's handle cases where we don't have exactly 4 points
-            if len(cnt) >= 4:
-                # If more than 4 points, use the 4 corner points
-                if len(cnt) > 4:
-                    # Use bounding rectangle as fallback
-                    x, y, w, h = cv2.boundingRect(cnt)
-                    pts = np.array([[x, y], [x+w, y], [x+w, y+h], [x, y+h]], dtype=np.float32)
-                else:
-                    pts = cnt.reshape(4, 2).astype(np.float32)
-                
-                warped = four_point_transform(image, pts)
-                dealer_cards.append(warped)
-                print(f"Successfully warped dealer card {i+1}")
-            else:
-                print(f"Dealer contour {i+1} has insufficient points: {len(cnt)}")
+            warped.append(card.warp(image))
+            logger.debug("warped region=%s card=%d", card.region, i + 1)
         except Exception as e:
-            print(f"Error warping dealer card {i+1}: {e}")
-    
-    player1_cards = []
-    player2_cards = []
-    
-    if players == 1:
-        for i, cnt in enumerate(player_contours):
-            try:
-                if len(cnt) >= 4:
-                    if len(cnt) > 4:
-                        x, y, w, h = cv2.boundingRect(cnt)
-                        pts = np.array([[x, y], [x+w, y], [x+w, y+h], [x, y+h]], dtype=np.float32)
-                    else:
-                        pts = cnt.reshape(4, 2).astype(np.float32)
-                    
-                    warped = four_point_transform(image, pts)
-                    player1_cards.append(warped)
-                    print(f"Successfully warped player card {i+1}")
-                else:
-                    print(f"Player contour {i+1} has insufficient points: {len(cnt)}")
-            except Exception as e:
-                print(f"Error warping player card {i+1}: {e}")
-    else:
-        # Split player contours for 2 players
-        mid_x = w / 2
-        for i, cnt in enumerate(player_contours):
-            M = cv2.moments(cnt)
-            if M["m00"] != 0:
-                cX = int(M["m10"] / M["m00"])
-            else:
-                x, y, ww, hh = cv2.boundingRect(cnt)
-                cX = x + ww // 2
-            
-            try:
-                if len(cnt) >= 4:
-                    if len(cnt) > 4:
-                        x, y, w, h = cv2.boundingRect(cnt)
-                        pts = np.array([[x, y], [x+w, y], [x+w, y+h], [x, y+h]], dtype=np.float32)
-                    else:
-                        pts = cnt.reshape(4, 2).astype(np.float32)
-                    
-                    warped = four_point_transform(image, pts)
-                    if cX >= mid_x:
-                        player1_cards.append(warped)  # Right side
-                        print(f"Successfully warped player1 card {len(player1_cards)}")
-                    else:
-                        player2_cards.append(warped)  # Left side
-                        print(f"Successfully warped player2 card {len(player2_cards)}")
-                else:
-                    print(f"Player contour {i+1} has insufficient points: {len(cnt)}")
-            except Exception as e:
-                print(f"Error warping player card {i+1}: {e}")
-    
-    print(f"Extracted cards: {len(dealer_cards)} dealer, {len(player1_cards)} player1, {len(player2_cards)} player2")
-    return dealer_cards, player1_cards, player2_cards
+            warped.append(None)
+            logger.warning("warp failed region=%s card=%d error=%s", card.region, i + 1, e)
+    if timings is not None:
+        timings.lap("warp", start)
+    return warped
 
-def match_cards_to_templates(warped_cards: List[np.ndarray], templates: List[Tuple[str, np.ndarray]]) -> List[str]:
-    """Match warped cards to templates using multi-metric scoring"""
-    detected_ranks = []
+def match_cards_to_templates(warped_cards: List[np.ndarray], bank: TemplateBank, timings: "StageTimings" = None,
+                             top_k: int = None, mode: str = None, priors: List[Optional[str]] = None) -> List[str]:
+    """Ranks of the warped cards that matched a template confidently, in order (see classify_cards)"""
+    ranks = classify_cards(warped_cards, bank, timings, top_k, mode, priors)
+    return [rank for rank in ranks if rank is not None]
+
+def classify_cards(warped_cards: List[np.ndarray], bank: TemplateBank, timings: "StageTimings" = None,
+                   top_k: int = None, mode: str = None, priors: List[Optional[str]] = None) -> List[Optional[str]]:
+    """
+    Match warped cards to templates, one rank per card (None below the confidence threshold). mode "full" uses multi-metric scoring of the
+    whole card (pruned to top_k candidates), "cascade" the same scoring with an
+    early exit, trying each card's prior rank (e.g. its rank in the previous
+    frame) first, "corner" only the rank index and "descriptor" a nearest-
+    neighbour lookup of HOG descriptors; mode and top_k default to
+    MATCH_MODE / MATCH_TOP_K.
+    """
+    if not warped_cards or len(bank) == 0:
+        return [None] * len(warped_cards)
     
-    # Prepare template dict by rank (like in notebook)
-    card_templates = {}
-    for name, template in templates:
-        # Resize template to match warped card size
-        template_resized = cv2.resize(template, (200, 300))
-        template_blurred = cv2.GaussianBlur(template_resized, (3, 3), 0)
-        
-        # Extract rank
-        rank_name = name.split()[0]  # "Ace", "King", etc.
-        if rank_name not in card_templates:
-            card_templates[rank_name] = []
-        card_templates[rank_name].append(template_blurred)
+    detected_ranks = []
+    # Score all cards against all templates at once, then keep the best variant per rank
+    start = time.perf_counter()
+    top_k = MATCH_TOP_K if top_k is None else top_k
+    mode = MATCH_MODE if mode is None else mode
+    if mode == "corner":
+        scores = bank.score_corners(warped_cards, CORNER_CONFIRM)
+        evaluated = [len(bank)] * len(warped_cards)
+    elif mode == "cascade":
+        scores, evaluated = bank.score_cascade(warped_cards, priors)
+    elif mode == "descriptor":
+        scores, evaluated = bank.score_descriptors(warped_cards)
+    else:
+        scores = bank.score_cards(warped_cards, top_k)
+        evaluated = [top_k if 0 < top_k < len(bank) else len(bank)] * len(warped_cards)
+    rank_scores = bank.best_per_rank(scores)
+    if timings is not None:
+        timings.lap("match", start)
+        timings.templates_evaluated.extend(evaluated)
     
-    # Match each warped card
-    for i, card in enumerate(warped_cards):
-        # Convert to grayscale and blur
-        card_gray = cv2.cvtColor(card, cv2.COLOR_BGR2GRAY)
-        card_blurred = cv2.GaussianBlur(card_gray, (3, 3), 0)
-        
-        best_rank = None
-        best_score = -1
-        
-        # Try each rank
-        for rank, rank_templates in card_templates.items():
-            max_score_for_rank = -1
-            
-            # Try each template variant for this rank
-            for template in rank_templates:
-                score = combined_card_score(card_blurred, template)
-                if score > max_score_for_rank:
-                    max_score_for_rank = score
-            
-            if max_score_for_rank > best_score:
-                best_score = max_score_for_rank
-                best_rank = rank
+    for i, row in enumerate(rank_scores):
+        best = int(np.argmax(row))
+        best_rank = bank.rank_names[best]
+        best_score = float(row[best])
         
         if best_rank and best_score > 0.3:  # Minimum confidence threshold
             detected_ranks.append(best_rank)
-            print(f"Card {i+1}: {best_rank} (confidence: {best_score:.3f})")
+            logger.debug("card=%d rank=%s confidence=%.3f evaluated=%d", i + 1, best_rank, best_score, evaluated[i])
         else:
-            print(f"Card {i+1}: No match found (best score: {best_score:.3f})")
+            detected_ranks.append(None)
+            logger.debug("card=%d rank=none best_score=%.3f evaluated=%d", i + 1, best_score, evaluated[i])
     
     return detected_ranks
 
@@ -327,8 +951,6 @@ def calculate_score(cards: List[str]) -> int:
     aces = 0
     
     for card_rank in cards:
-        print(f"Processing card rank: {card_rank}")
-        
         if card_rank == 'Ace':
             aces += 1
             score += 11
@@ -341,7 +963,7 @@ def calculate_score(cards: List[str]) -> int:
                     if 2 <= card_value <= 10:
                         score += card_value
                 except ValueError:
-                    print(f"Warning: Unknown card rank '{card_rank}'")
+                    logger.warning("unknown card rank=%r", card_rank)
             else:
                 score += card_value
 
@@ -350,26 +972,220 @@ def calculate_score(cards: List[str]) -> int:
         score -= 10
         aces -= 1
 
-    print(f"Final score for {cards}: {score}")
+    logger.debug("score cards=%s score=%d", cards, score)
     return score
 
+# === Dealer outcome engine ===
+CARD_VALUES = {
+    'Ace': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9,
+    '10': 10, 'Jack': 10, 'Queen': 10, 'King': 10,
+}
+DEALER_FINALS = (17, 18, 19, 20, 21)  # dealer_outcomes order; the last entry is bust
+
+def shoe_composition(seen: List[str] = (), decks: int = None) -> Tuple[int, ...]:
+    """Cards left per value (Ace, 2..9, ten-valued) in a shoe of 'decks' decks after the seen ranks were dealt"""
+    decks = SHOE_DECKS if decks is None else decks
+    counts = [4 * decks] * 9 + [16 * decks]
+    for rank in seen:
+        value = CARD_VALUES.get(rank)
+        if value is not None and counts[value - 1] > 0:
+            counts[value - 1] -= 1
+    return tuple(counts)
+
+def hand_state(ranks: List[str]) -> Tuple[int, bool]:
+    """(best total, soft) of a hand; soft means an Ace is counted as 11"""
+    values = [CARD_VALUES[rank] for rank in ranks if rank in CARD_VALUES]
+    total = sum(values)
+    if 1 in values and total + 10 <= 21:
+        return total + 10, True
+    return total, False
+
+def add_card(total: int, soft: bool, value: int) -> Tuple[int, bool]:
+    total += value
+    if value == 1 and total + 10 <= 21:
+        return total + 10, True
+    if total > 21 and soft:
+        return total - 10, False
+    return total, soft
+
+@functools.lru_cache(maxsize=ODDS_CACHE_SIZE)
+def dealer_outcomes(total: int, soft: bool, composition: Tuple[int, ...]) -> Tuple[float, ...]:
+    """
+    Exact probabilities that a dealer hand at (total, soft) finishes on 17, 18, 19, 20, 21
+    or busts, drawing without replacement from 'composition'. Memoized by its arguments.
+    """
+    memo = {}
+    counts = list(composition)
+
+    def finish(total, soft):
+        if total > 21:
+            return (0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+        if total > 17 or (total == 17 and not (soft and DEALER_HITS_SOFT_17)):
+            return tuple(1.0 if final == total else 0.0 for final in DEALER_FINALS) + (0.0,)
+        key = (total, soft, tuple(counts))
+        if key in memo:
+            return memo[key]
+        remaining = sum(counts)
+        dist = [0.0] * 6
+        for index, count in enumerate(counts):
+            if count:
+                counts[index] -= 1
+                outcome = finish(*add_card(total, soft, index + 1))
+                counts[index] += 1
+                p = count / remaining
+                for j in range(6):
+                    dist[j] += p * outcome[j]
+        memo[key] = tuple(dist)
+        return memo[key]
+
+    return finish(total, soft)
+
+@functools.lru_cache(maxsize=ODDS_CACHE_SIZE)
+def strategy_table(dealer_total: int, dealer_soft: bool, composition: Tuple[int, ...]) -> dict:
+    """
+    Best play for every player state against a dealer hand, as {(total, soft): (action,
+    (ev, win, push, lose), double (ev, win, push, lose))}. Dealer outcomes are exact for
+    'composition'; the player's own draws use its card frequencies without depleting it.
+    """
+    dealer = dealer_outcomes(dealer_total, dealer_soft, composition)
+    remaining = sum(composition)
+    draws = [(index + 1, count / remaining) for index, count in enumerate(composition) if count]
+    busted = (-1.0, 0.0, 0.0, 1.0)
+    table = {}
+
+    def stand(total):
+        if total > 21:
+            return busted
+        win = dealer[5] + sum(p for final, p in zip(DEALER_FINALS, dealer) if final < total)
+        push = dealer[DEALER_FINALS.index(total)] if total >= 17 else 0.0
+        lose = 1.0 - win - push
+        return win - lose, win, push, lose
+
+    def expected(outcomes):
+        return tuple(sum(p * outcome[j] for p, outcome in outcomes) for j in range(4))
+
+    def best(total, soft):
+        if total > 21:
+            return busted
+        if (total, soft) not in table:
+            stand_now = stand(total)
+            if total == 21:
+                table[(total, soft)] = ("stand", stand_now, None)
+            else:
+                hits = [(p, add_card(total, soft, value)) for value, p in draws]
+                hit = expected([(p, best(*state)) for p, state in hits])
+                double = expected([(p, stand(state[0])) for p, state in hits])
+                double = (2 * double[0],) + double[1:]
+                table[(total, soft)] = ("hit", hit, double) if hit[0] > stand_now[0] else ("stand", stand_now, double)
+        return table[(total, soft)][1]
+
+    # Every reachable state, down to the single-card hands a live table shows first
+    for total in range(2, 22):
+        best(total, False)
+    for total in range(11, 22):
+        best(total, True)
+    return table
+
+def evaluate_hand(dealer: List[str], player: List[str], composition: Tuple[int, ...] = None) -> Optional[dict]:
+    """
+    Win, push and lose probabilities under the recommended action ("hit", "stand" or, on
+    two cards, "double"), plus the chance that the next card busts the hand. composition
+    defaults to the shoe minus the dealer's and player's cards. None without cards to go on.
+    The dealer does not peek for blackjack and naturals count as ordinary 21s.
+    """
+    dealer_state, (total, soft) = hand_state(dealer), hand_state(player)
+    if not dealer_state[0] or not total:
+        return None
+    if total > 21:
+        return {"action": None, "win": 0.0, "push": 0.0, "lose": 1.0, "bust": 1.0}
+    composition = composition or shoe_composition(list(dealer) + list(player))
+    action, (ev, win, push, lose), double = strategy_table(*dealer_state, composition)[(total, soft)]
+    if len(player) == 2 and double is not None and double[0] > ev:
+        action, (ev, win, push, lose) = "double", double
+    bust = 0.0 if soft else sum(composition[21 - total:]) / sum(composition)
+    return {"action": action, "win": round(win, 4), "push": round(push, 4), "lose": round(lose, 4), "bust": round(bust, 4)}
+
+def precompute_odds_tables():
+    """Fill the memo with the strategy tables for a full shoe against every dealer upcard"""
+    for value in range(1, 11):
+        rank = "Ace" if value == 1 else str(value)
+        strategy_table(*hand_state([rank]), shoe_composition([rank]))
+
+def evaluate_hands(hands: List[dict], decks: int = None) -> List[Optional[dict]]:
+    """
+    evaluate_hand for many {"dealer": [...], "player": [...], "seen": [...]} hands, where
+    "seen" lists other cards already dealt from the shoe. Hands with the same dealer
+    cards and composition share one memoized strategy table.
+    """
+    results = []
+    for hand in hands:
+        dealer, player = hand.get("dealer", []), hand.get("player", [])
+        composition = shoe_composition(list(dealer) + list(player) + list(hand.get("seen", [])), decks)
+        results.append(evaluate_hand(dealer, player, composition))
+    return results
+
+@app.post("/odds")
+async def odds(payload: dict = Body(...)):
+    """
+    Batch hand evaluation: {"hands": [{"dealer": [...], "player": [...], "seen": [...]}, ...],
+    "decks": n} -> {"results": [...], "total": n}, one evaluate_hand result per hand.
+    """
+    request_start = time.perf_counter()
+    hands, decks = payload.get("hands"), payload.get("decks")
+    valid = isinstance(hands, list) and all(
+        isinstance(hand, dict) and all(
+            isinstance(hand.get(key, []), list) and all(isinstance(rank, str) for rank in hand.get(key, []))
+            for key in ("dealer", "player", "seen")
+        )
+        for hand in hands
+    )
+    if not valid or (decks is not None and not (isinstance(decks, int) and decks > 0)):
+        record_request("odds", 400, request_start)
+        return JSONResponse(
+            status_code=400,
+            content={"error": 'Expected {"hands": [{"dealer": [ranks], "player": [ranks], "seen": [ranks]}], "decks": n}'}
+        )
+    if len(hands) > ODDS_MAX_HANDS:
+        record_request("odds", 413, request_start)
+        return JSONResponse(status_code=413, content={"error": f"Got {len(hands)} hands, limit is {ODDS_MAX_HANDS}"})
+
+    # Tables for new compositions take milliseconds each, so stay off the event loop
+    results = await asyncio.to_thread(evaluate_hands, hands, decks)
+    record_request("odds", 200, request_start)
+    return {"results": results, "total": len(results)}
+
 # === Debug endpoint ===
 @app.get("/debug/templates")
 async def debug_templates():
     template_info = []
-    for name, template in TEMPLATES:
+    bank = _template_bank  # never build it here: that would stall the event loop
+    if bank is None:
+        return JSONResponse(status_code=503, content={"error": "Template bank is loading", "status": READINESS.status})
+    for name, shape in zip(bank.names, bank.template_shapes):
         template_info.append({
             "name": name,
-            "shape": template.shape,
-            "size": f"{template.shape[1]}x{template.shape[0]}"
+            "shape": shape,
+            "size": f"{shape[1]}x{shape[0]}"
         })
-    return {"templates": template_info, "total": len(TEMPLATES)}
+    return {"templates": template_info, "total": len(bank), "version": bank.version, "generation": _template_bank_generation}
+
+# === Metrics Endpoint ===
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 # === Health Check Endpoint ===
 @app.get("/health")
 async def health_check():
     return {"status": "ok", "message": "Backend is running"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once the background warm-up has finished, 503 until then (or if it failed)"""
+    if READINESS.status != "ready":
+        return JSONResponse(status_code=503, content=READINESS.state())
+    return READINESS.state()
+
 # === Main API Endpoints ===
 @app.get("/analyze/")
 async def analyze_get():
@@ -379,93 +1195,1626 @@ async def analyze_get():
         "test_endpoint": "/debug/templates"
     }
 
-@app.post("/analyze/")
-async def analyze_image(file: UploadFile = File(...), players: int = Form(...)):
+# === Analysis pipeline ===
+class ImageDecodeError(ValueError):
+    """Raised when the uploaded bytes are not a decodable image"""
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload is over the byte limit or its header claims too many pixels"""
+
+def read_image_size(image_data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) from the PNG/JPEG/GIF/BMP/WebP/TIFF header without decoding any
+    pixels, or None when the format is not recognized or the header is truncated.
+    """
+    if image_data[:8] == b"\x89PNG\r\n\x1a\n" and len(image_data) >= 24:
+        return struct.unpack(">II", image_data[16:24])
+    if image_data[:6] in (b"GIF87a", b"GIF89a") and len(image_data) >= 10:
+        return struct.unpack("<HH", image_data[6:10])
+    if image_data[:2] == b"BM" and len(image_data) >= 26:
+        width, height = struct.unpack("<ii", image_data[18:26])
+        return width, abs(height)
+    if image_data[:2] == b"\xff\xd8":
+        # Walk the marker segments up to the first start-of-frame
+        pos = 2
+        while pos + 9 <= len(image_data):
+            if image_data[pos] != 0xFF:
+                return None
+            marker = image_data[pos + 1]
+            if marker == 0xFF:  # fill byte
+                pos += 1
+                continue
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # standalone markers
+                pos += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", image_data[pos + 5:pos + 9])
+                return width, height
+            (segment_length,) = struct.unpack(">H", image_data[pos + 2:pos + 4])
+            pos += 2 + segment_length
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP" and len(image_data) >= 30:
+        chunk = image_data[12:16]
+        if chunk == b"VP8 " and image_data[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", image_data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L" and image_data[20] == 0x2F:
+            (bits,) = struct.unpack("<I", image_data[21:25])
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return (int.from_bytes(image_data[24:27], "little") + 1,
+                    int.from_bytes(image_data[27:30], "little") + 1)
+        return None
+    if image_data[:4] in (b"II*\x00", b"MM\x00*") and len(image_data) >= 8:
+        # First image file directory: ImageWidth (256) and ImageLength (257) entries
+        order = "<" if image_data[:2] == b"II" else ">"
+        (offset,) = struct.unpack(order + "I", image_data[4:8])
+        if offset + 2 > len(image_data):
+            return None
+        (entries,) = struct.unpack(order + "H", image_data[offset:offset + 2])
+        tags = {}
+        for pos in range(offset + 2, min(offset + 2 + 12 * entries, len(image_data) - 11), 12):
+            tag, kind = struct.unpack(order + "HH", image_data[pos:pos + 4])
+            if tag in (256, 257):
+                tags[tag] = struct.unpack(order + ("H" if kind == 3 else "I"), image_data[pos + 8:pos + (10 if kind == 3 else 12)])[0]
+        if 256 in tags and 257 in tags:
+            return tags[256], tags[257]
+    return None
+
+def check_image_pixels(size: Optional[Tuple[int, int]]):
+    """Reject an image whose header claims more than MAX_IMAGE_PIXELS, before anything is decoded"""
+    if size is not None and size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise UploadTooLarge(f"Image is {size[0]}x{size[1]}, limit is {MAX_IMAGE_PIXELS} pixels")
+
+async def read_upload(upload: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES, image: bool = True) -> bytearray:
+    """
+    Read an upload chunk by chunk into one buffer, raising UploadTooLarge as soon as it
+    is over max_bytes or (for images) its header claims more than MAX_IMAGE_PIXELS,
+    without reading the rest. The buffer is what gets decoded, hashed and sent to the
+    pool; np.frombuffer wraps it without a copy.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(f"Upload is {upload.size} bytes, limit is {max_bytes}")
+    buffer = bytearray()
+    header_checked = not image
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return buffer
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise UploadTooLarge(f"Upload is over the {max_bytes} byte limit")
+        if not header_checked:
+            size = read_image_size(buffer)
+            check_image_pixels(size)
+            header_checked = size is not None or len(buffer) >= UPLOAD_HEADER_BYTES
+
+@app.middleware("http")
+async def limit_upload_size(request, call_next):
+    """
+    Turn away uploads whose declared Content-Length is over the limit before the body is read.
+    Uploads without one (chunked bodies) get 411, as their size is only known once received.
+    """
+    if request.url.path == "/analyze/":
+        limit = MAX_UPLOAD_BYTES + UPLOAD_CHUNK_SIZE  # room for the multipart framing and form fields
+    elif request.url.path in ("/analyze/batch", "/jobs"):
+        limit = MAX_BATCH_BYTES
+    else:
+        return await call_next(request)
+    length = request.headers.get("content-length", "")
+    if request.method != "POST":
+        return await call_next(request)
+    if not length.isdigit():
+        return JSONResponse(status_code=411, content={"error": "Uploads need a Content-Length header"})
+    if int(length) > limit:
+        return JSONResponse(status_code=413, content={"error": f"Request is {length} bytes, limit is {limit}"})
+    return await call_next(request)
+
+def reduced_decode_flag(size: Optional[Tuple[int, int]], max_dimension: int = None) -> int:
+    """
+    Largest IMREAD_REDUCED_COLOR_* factor that still leaves the long side at or
+    above max_dimension (default MAX_IMAGE_DIMENSION); JPEG decodes at that scale
+    directly in the DCT.
+    """
+    max_dimension = MAX_IMAGE_DIMENSION if max_dimension is None else max_dimension
+    if size is None:
+        return cv2.IMREAD_COLOR
+    long_side = max(size)
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if long_side // factor >= max_dimension:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def decode_image(image_data: bytes, timings: "StageTimings" = None, max_dimension: int = None) -> np.ndarray:
+    """Decode uploaded bytes and bring the image into the 400..1500px (max_dimension) working range"""
+    timings = timings if timings is not None else StageTimings()
+    max_dimension = MAX_IMAGE_DIMENSION if max_dimension is None else max_dimension
+    start = time.perf_counter()
+    size = read_image_size(image_data)
+    if size is None:
+        # Without the dimensions the pixel limit cannot be enforced before decoding
+        raise ImageDecodeError("Unsupported or truncated image; expected JPEG, PNG, GIF, BMP, WebP or TIFF")
+    check_image_pixels(size)
+    nparr = np.frombuffer(image_data, np.uint8)
+    image = cv2.imdecode(nparr, reduced_decode_flag(size, max_dimension))
+    start = timings.lap("decode", start)
+    
+    if image is None:
+        raise ImageDecodeError("Could not decode image")
+    
+    if max(size) != max(image.shape[:2]):
+        logger.debug("decoded reduced size=%dx%d shape=%s", size[0], size[1], image.shape)
+    else:
+        logger.debug("decoded shape=%s", image.shape)
+    
+    # Limit image resolution to max 1500 pixels in any direction
+    height, width = image.shape[:2]
+    if height > max_dimension or width > max_dimension:
+        # Calculate scale factor to fit within max_dimension x max_dimension
+        scale_factor = min(max_dimension / height, max_dimension / width)
+        new_width = int(width * scale_factor)
+        new_height = int(height * scale_factor)
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+        logger.debug("downscaled from=%dx%d to=%dx%d scale=%.3f", width, height, new_width, new_height, scale_factor)
+    
+    # Resize image if it's too small (but maintain aspect ratio)
+    min_height, min_width = MIN_IMAGE_DIMENSION, MIN_IMAGE_DIMENSION
+    if image.shape[0] < min_height or image.shape[1] < min_width:
+        scale_factor = max(min_height / image.shape[0], min_width / image.shape[1])
+        new_width = int(image.shape[1] * scale_factor)
+        new_height = int(image.shape[0] * scale_factor)
+        image = cv2.resize(image, (new_width, new_height))
+        logger.debug("upscaled shape=%s", image.shape)
+
+    timings.lap("resize", start)
+    return image
+
+def analyze_image_array(image: np.ndarray, players: int, timings: "StageTimings" = None,
+                        detection_size: int = None, mode: str = None) -> dict:
+    """
+    Detect, match and score the cards in a decoded, resized image. detection_size and
+    mode default to DETECTION_MAX_DIMENSION / MATCH_MODE.
+    """
+    timings = timings if timings is not None else StageTimings()
+    
+    # Use notebook-style detection instead of simple region splitting
+    detections = detect_and_classify_cards(image, players, timings, detection_size)
+    
+    # Warp and match each hand's cards
+    bank = get_template_bank()
+    def hand_ranks(hand):
+        warped = warp_cards(image, [card for card in detections if card.region == hand], timings)
+        cards = [card for card in warped if card is not None]
+        return match_cards_to_templates(cards, bank, timings, mode=mode)
+
+    dealer_ranks = hand_ranks("dealer")
+    player1_ranks = hand_ranks("player1")
+    player2_ranks = hand_ranks("player2")
+    
+    logger.info("detected dealer=%s player1=%s player2=%s", dealer_ranks, player1_ranks, player2_ranks)
+    start = time.perf_counter()
+    results = hand_results({"dealer": dealer_ranks, "player1": player1_ranks, "player2": player2_ranks}, players)
+    timings.lap("score", start)
+    return results
+
+def hand_results(ranks: dict, players: int) -> dict:
+    """
+    Response body for per-hand rank lists: cards and blackjack score for dealer, player1[, player2],
+    and for each player the odds against the dealer (evaluate_hand), from the precomputed tables
+    for the dealer's cards or, with ODDS_EXACT, given every card on the table
+    """
+    hands = REGIONS[:players + 1]
+    seen = hands if ODDS_EXACT else ["dealer"]
+    composition = shoe_composition([rank for hand in seen for rank in ranks.get(hand, [])])
+    results = {}
+    for hand in hands:
+        cards = ranks.get(hand, [])
+        results[hand] = {"cards": cards, "score": calculate_score(cards)}
+        if hand != "dealer":
+            results[hand]["odds"] = evaluate_hand(ranks.get("dealer", []), cards, composition)
+    return results
+
+def analyze_image_bytes(image_data: bytes, players: int, timings: "StageTimings" = None, tier: str = "full") -> dict:
+    """
+    Full CPU-bound pipeline for one upload: decode, resize, detect, match, score,
+    with the image sizes and matcher of the given quality tier.
+    Runs inside an analysis worker process, so it must stay picklable and only
+    depend on module-level state.
+    """
+    max_dimension, detection_size, mode = tier_settings(tier)
+    image = decode_image(image_data, timings, max_dimension)
+    logger.debug("players=%d tier=%s", players, tier)
+    return analyze_image_array(image, players, timings, detection_size=detection_size, mode=mode)
+
+def tier_settings(tier: str) -> Tuple[int, int, str]:
+    """(max image dimension, detection max dimension, match mode) of a quality tier, never above the configured sizes"""
+    _, max_dimension, detection_size, mode = QUALITY_TIERS[tier]
+    if max_dimension is not None:
+        max_dimension = min(max_dimension, MAX_IMAGE_DIMENSION)
+    if detection_size is not None and DETECTION_MAX_DIMENSION > 0:
+        detection_size = min(detection_size, DETECTION_MAX_DIMENSION)
+    return max_dimension, detection_size, mode
+
+def timed_analysis(image_data: bytes, players: int, tier: str = "full", deadline: float = None) -> Tuple[dict, dict]:
+    """
+    Pool entry point: analyze_image_bytes plus its per-stage timings for the parent to record.
+    Skips the work when it only gets to run after the wall-clock deadline.
+    """
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded("Analysis deadline passed before it started")
+    timings = StageTimings()
+    results = analyze_image_bytes(image_data, players, timings, tier)
+    results["quality"] = tier
+    return results, timings
+
+# === Analysis worker pool ===
+def init_analysis_worker():
+    """Process-pool initializer: one OpenCV thread per process, a warm template bank and odds tables"""
+    cv2.setNumThreads(1)
+    get_template_bank()
+    precompute_odds_tables()
+
+def start_analysis_pool():
+    """Create the process pool, or leave it unset to run analyses on the thread pool (ANALYZE_WORKERS=0)"""
+    global ANALYSIS_POOL
+    if ANALYZE_WORKERS <= 0:
+        ANALYSIS_POOL = None
+        return
+    # spawn: forking a process that already runs an event loop and OpenCV threads is unsafe,
+    # and max_tasks_per_child does not support fork anyway
+    ANALYSIS_POOL = ProcessPoolExecutor(
+        max_workers=ANALYZE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_analysis_worker,
+        max_tasks_per_child=ANALYZE_MAX_TASKS_PER_WORKER,
+    )
+    logger.info("analysis pool started workers=%d", ANALYZE_WORKERS)
+
+def stop_analysis_pool():
+    global ANALYSIS_POOL
+    if ANALYSIS_POOL is not None:
+        ANALYSIS_POOL.shutdown(wait=True, cancel_futures=True)
+        ANALYSIS_POOL = None
+
+def restart_analysis_pool(broken: ProcessPoolExecutor):
+    """
+    Replace a pool that lost a worker, once: later callers that saw the same pool break
+    find it already replaced. Every future of a broken pool has already failed, so it is
+    shut down without waiting or cancelling anything submitted to the new one.
+    """
+    if ANALYSIS_POOL is not broken:
+        return
+    logger.error("analysis pool broken, restarting it")
+    start_analysis_pool()
+    broken.shutdown(wait=False)
+
+async def run_analysis(func, *args):
+    """Run a CPU-bound pipeline function off the event loop, on the server's current template bank"""
+    loop = asyncio.get_running_loop()
+    pool = ANALYSIS_POOL
+    if pool is not None and _template_bank is not None:
+        args = (_template_bank_generation, _template_bank.version, func) + args
+        func = with_template_bank
     try:
-        image_data = await file.read()
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return JSONResponse(
-                status_code=400, 
-                content={"error": "Could not decode image"}
-            )
-        
-        print(f"Original image format: {file.content_type}")
-        print(f"Image shape: {image.shape}")
-        print(f"Number of players: {players}")
-        
-        # Convert to PNG format as part of preprocessing
-        # Encode as PNG and decode back to ensure consistent format
-        success, png_buffer = cv2.imencode('.png', image)
-        if not success:
-            return JSONResponse(
-                status_code=500,
-                content={"error": "Failed to convert image to PNG format"}
-            )
-        
-        # Decode the PNG back to ensure we're working with PNG-processed image
-        image = cv2.imdecode(png_buffer, cv2.IMREAD_COLOR)
-        print(f"Converted to PNG format - Image shape: {image.shape}")
-        
-        # Limit image resolution to max 1500 pixels in any direction
-        max_dimension = 1500
-        height, width = image.shape[:2]
-        if height > max_dimension or width > max_dimension:
-            # Calculate scale factor to fit within max_dimension x max_dimension
-            scale_factor = min(max_dimension / height, max_dimension / width)
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
-            print(f"Reduced resolution from {width}x{height} to {new_width}x{new_height} (scale: {scale_factor:.3f})")
-        
-        # Resize image if it's too small (but maintain aspect ratio)
-        min_height, min_width = 400, 400
-        if image.shape[0] < min_height or image.shape[1] < min_width:
-            scale_factor = max(min_height / image.shape[0], min_width / image.shape[1])
-            new_width = int(image.shape[1] * scale_factor)
-            new_height = int(image.shape[0] * scale_factor)
-            image = cv2.resize(image, (new_width, new_height))
-            print(f"Upscaled small image to: {image.shape}")
-
-        # Use notebook-style detection instead of simple region splitting
-        dealer_cards, player1_cards, player2_cards = detect_and_classify_cards(image, players)
-        
-        # Match cards to templates
-        dealer_ranks = match_cards_to_templates(dealer_cards, TEMPLATES)
-        player1_ranks = match_cards_to_templates(player1_cards, TEMPLATES)
-        player2_ranks = match_cards_to_templates(player2_cards, TEMPLATES) if player2_cards else []
-        
-        print(f"Detected cards - Dealer: {dealer_ranks}, Player1: {player1_ranks}, Player2: {player2_ranks}")
-
-        results = {
-            "dealer": {
-                "cards": dealer_ranks,
-                "score": calculate_score(dealer_ranks)
-            },
-            "player1": {
-                "cards": player1_ranks,
-                "score": calculate_score(player1_ranks)
-            }
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); replace the pool so later requests still work
+        restart_analysis_pool(pool)
+        raise
+
+# === Startup warm-up ===
+def warmup_image() -> bytes:
+    """JPEG of a felt table with a dealer and a player card, built from two card templates"""
+    files = sorted(file for file in os.listdir(CARD_TEMPLATES_PATH) if file.endswith(".png"))[:2]
+    scene = np.full((900, 1200, 3), (35, 110, 35), np.uint8)
+    for file, (x, y) in zip(files, ((525, 120), (525, 570))):
+        card = cv2.imread(os.path.join(CARD_TEMPLATES_PATH, file), cv2.IMREAD_COLOR)
+        scene[y:y + 210, x:x + 150] = cv2.resize(card, (150, 210), interpolation=cv2.INTER_AREA)
+    return cv2.imencode(".jpg", scene)[1].tobytes()
+
+class Readiness:
+    """
+    Background warm-up started with the server: loads the template bank and odds tables,
+    then runs WARMUP_ANALYSES synthetic analyses (cycling through the quality tiers) so
+    every pool worker is spawned and primed. The port is bound meanwhile; /ready reports
+    when it is done.
+    """
+
+    def __init__(self):
+        self.status = "starting"
+        self.error = None
+        self.seconds = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._warm_up())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def state(self) -> dict:
+        state = {"status": self.status}
+        if self.seconds is not None:
+            state["warmup_seconds"] = round(self.seconds, 3)
+        if self.error is not None:
+            state["error"] = self.error
+        return state
+
+    async def _warm_up(self):
+        start = time.perf_counter()
+        self.status = "warming_up"
+        try:
+            await asyncio.to_thread(get_template_bank)
+            await asyncio.to_thread(precompute_odds_tables)
+            image_data = await asyncio.to_thread(warmup_image)
+            tiers = list(QUALITY_TIERS)
+            await asyncio.gather(*(
+                run_analysis(timed_analysis, image_data, 1, tiers[i % len(tiers)]) for i in range(WARMUP_ANALYSES)
+            ))
+        except Exception as e:
+            logger.exception("warm-up failed")
+            self.status, self.error = "failed", str(e)
+            return
+        self.seconds = time.perf_counter() - start
+        self.status = "ready"
+        logger.info("warm-up done analyses=%d seconds=%.3f", WARMUP_ANALYSES, self.seconds)
+
+READINESS = Readiness()
+METRICS.append(Gauge("bjv_ready", "1 once startup warm-up has finished", lambda: int(READINESS.status == "ready")))
+
+# === Template hot reload ===
+def template_signature() -> tuple:
+    """Name, size and modification time of every template image; changes when the set does"""
+    with os.scandir(CARD_TEMPLATES_PATH) as entries:
+        return tuple(sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in entries if entry.name.endswith(".png")
+        ))
+
+def prune_template_cache(keep: set):
+    """
+    Delete the cached banks in TEMPLATE_CACHE_PATH other than 'keep'. The previous version
+    is kept for workers still switching from it; anything older is no longer used.
+    """
+    try:
+        entries = os.listdir(TEMPLATE_CACHE_PATH)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(TEMPLATE_CACHE_PATH, entry)
+        if entry not in keep and ".tmp-" not in entry and os.path.isfile(os.path.join(path, "meta.json")):
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info("template cache pruned version=%s", entry)
+
+class TemplateReloader:
+    """
+    Rebuilds the template bank when CARD_TEMPLATES_PATH changes (polled every 'interval'
+    seconds, once the directory has stopped changing for a whole interval) or on request.
+    The new bank is built off the event loop while the old one keeps serving, then swapped
+    in with a single reference assignment; pool workers switch on their next task
+    (with_template_bank). A bank that fails to build leaves the old one in place.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.signature = None
+        self.pending = None  # signature seen changing, not yet stable
+        self.lock = None
+        self.task = None
+        self.reloaded = None
+        self.error = None
+
+    def start(self):
+        self.lock = asyncio.Lock()
+        try:
+            self.signature = template_signature()
+        except OSError as e:
+            logger.warning("cannot read templates path=%s error=%s", CARD_TEMPLATES_PATH, e)
+        if self.interval > 0:
+            self.task = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def state(self) -> dict:
+        bank = _template_bank
+        return {
+            "version": template_bank_version(),
+            "generation": _template_bank_generation,
+            "templates": len(bank) if bank is not None else None,
+            "reloaded": self.reloaded,
+            "error": self.error,
+            "watch_interval": self.interval,
         }
 
-        if players == 2:
-            results["player2"] = {
-                "cards": player2_ranks,
-                "score": calculate_score(player2_ranks)
-            }
+    async def reload(self, reason: str) -> dict:
+        async with self.lock:
+            start = time.perf_counter()
+            try:
+                signature = await asyncio.to_thread(template_signature)
+                bank = await asyncio.to_thread(load_template_bank)
+                if len(bank) == 0:
+                    raise ValueError(f"No templates in {CARD_TEMPLATES_PATH}")
+            except Exception as e:
+                logger.exception("template reload failed reason=%s", reason)
+                TEMPLATE_RELOADS.inc("failed")
+                self.error = str(e)
+                return self.state()
+            self.signature, self.error = signature, None
+            previous = template_bank_version()
+            if bank.version == previous:
+                TEMPLATE_RELOADS.inc("unchanged")
+                return self.state()
+            set_template_bank(bank, _template_bank_generation + 1)
+            await asyncio.to_thread(prune_template_cache, {bank.version, previous})
+            self.reloaded = time.time()
+            TEMPLATE_RELOADS.inc("swapped")
+            logger.info("template bank reloaded reason=%s version=%s generation=%d templates=%d seconds=%.3f",
+                        reason, bank.version, _template_bank_generation, len(bank), time.perf_counter() - start)
+            return self.state()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                signature = await asyncio.to_thread(template_signature)
+            except OSError as e:
+                logger.warning("cannot read templates path=%s error=%s", CARD_TEMPLATES_PATH, e)
+                continue
+            if signature == self.signature:
+                self.pending = None
+            elif signature == self.pending:
+                self.pending = None
+                await self.reload("watch")
+            else:
+                self.pending = signature
+
+TEMPLATE_RELOADER = TemplateReloader(TEMPLATE_WATCH_INTERVAL)
+TEMPLATE_RELOADS = Counter("bjv_template_reloads_total", "Template bank reloads by outcome", ("outcome",))
+METRICS.extend([
+    TEMPLATE_RELOADS,
+    Gauge("bjv_template_bank_generation", "Template bank swaps since start", lambda: _template_bank_generation),
+])
+
+def admin_authorized(request: Request, token: Optional[str]) -> bool:
+    """The X-Admin-Token matches BJV_ADMIN_TOKEN or, with none configured, the client is on this machine"""
+    if ADMIN_TOKEN is None:
+        return request.client is not None and request.client.host in ("127.0.0.1", "::1", "localhost")
+    return token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+@app.get("/admin/templates")
+async def template_bank_state(request: Request, x_admin_token: str = Header(None)):
+    if not admin_authorized(request, x_admin_token):
+        return JSONResponse(status_code=403, content={"error": "Invalid admin token"})
+    return TEMPLATE_RELOADER.state()
+
+@app.post("/admin/templates/reload")
+async def reload_templates(request: Request, x_admin_token: str = Header(None)):
+    """Rebuild the template bank from CARD_TEMPLATES_PATH now and report the active version"""
+    if not admin_authorized(request, x_admin_token):
+        return JSONResponse(status_code=403, content={"error": "Invalid admin token"})
+    state = await TEMPLATE_RELOADER.reload("admin")
+    return JSONResponse(status_code=500 if state["error"] else 200, content=state)
 
-        return JSONResponse(content=results)
+# === Admission control ===
+class OverloadedError(RuntimeError):
+    pass
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+class AdmissionControl:
+    """
+    Caps the analyses running or queued on the pool at 'limit' and picks a cheaper
+    quality tier as that fills up. What happens at the cap depends on the priority:
+    "interactive" requests are turned away, "batch" items wait for a slot within
+    their deadline and "background" work (jobs) waits with no deadline. "live" frames
+    are turned away like interactive requests, and the stream moves on to its next
+    frame. Batch and
+    background ("bulk") analyses only get 'bulk_limit' of the slots, so a large batch
+    or job leaves the rest to interactive requests.
+    """
+
+    def __init__(self, limit: int, bulk_limit: int):
+        self.limit = limit
+        self.bulk_limit = min(bulk_limit, limit)
+        self.in_flight = 0
+        self.bulk_in_flight = 0
+        self.waiters = deque()  # bulk analyses waiting for a slot
+
+    def tier(self, in_flight: int = None) -> str:
+        """Quality tier for a new analysis while 'in_flight' (default: the current count) others run"""
+        load = (self.in_flight if in_flight is None else in_flight) / self.limit
+        tier = "full"
+        for name, (threshold, *_) in QUALITY_TIERS.items():
+            if load >= threshold:
+                tier = name
+        return tier
+
+    def _has_slot(self, bulk: bool) -> bool:
+        return self.in_flight < self.limit and (not bulk or self.bulk_in_flight < self.bulk_limit)
+
+    def _take(self, bulk: bool):
+        self.in_flight += 1
+        self.bulk_in_flight += bulk
+
+    async def acquire(self, bulk: bool = False):
+        """Take a slot; bulk analyses wait for one, the others raise OverloadedError"""
+        if self._has_slot(bulk) and not (bulk and self.waiters):  # bulk analyses queue in order
+            self._take(bulk)
+            return
+        if not bulk:
+            raise OverloadedError("Server is busy, retry later")
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter  # release() takes the slot on its behalf
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(bulk)
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self, bulk: bool = False):
+        self.in_flight -= 1
+        self.bulk_in_flight -= bulk
+        while self.waiters and self._has_slot(True):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self._take(True)
+                waiter.set_result(None)
+
+    async def run(self, image_data: bytes, players: int, priority: str = "interactive",
+                  analysis=None, extra: tuple = ()):
+        """
+        analysis(image_data, players, tier, wall-clock deadline, *extra), by default
+        timed_analysis, in an admitted slot at the tier for the load it was admitted under
+        ("full" for background work). All but background work give up after ANALYSIS_DEADLINE.
+        """
+        deadline = None if priority == "background" else ANALYSIS_DEADLINE or None
+        expires = time.time() + deadline if deadline else None
+        try:
+            return await asyncio.wait_for(self._run(image_data, players, priority, expires, analysis or timed_analysis, extra), deadline)
+        except asyncio.TimeoutError:
+            ADMISSIONS_TOTAL.inc("deadline", self.tier())
+            raise DeadlineExceeded(f"Analysis did not finish within {deadline:g}s")
+
+    async def _run(self, image_data: bytes, players: int, priority: str, expires: Optional[float], analysis, extra: tuple):
+        bulk = priority in ("batch", "background")
+        try:
+            await self.acquire(bulk)
+        except OverloadedError:
+            ADMISSIONS_TOTAL.inc("rejected", self.tier())
+            raise
+        tier = "full" if priority == "background" else self.tier(self.in_flight - 1)
+        ADMISSIONS_TOTAL.inc("admitted", tier)
+        task = asyncio.ensure_future(run_analysis(analysis, image_data, players, tier, expires, *extra))
+        task.add_done_callback(functools.partial(self._finished, bulk))
+        # Shielded: a timed-out pool task keeps its slot until the worker is actually free
+        return await asyncio.shield(task)
+
+    def _finished(self, bulk: bool, task: asyncio.Future):
+        self.release(bulk)
+        if not task.cancelled():
+            task.exception()  # retrieved here so abandoned tasks don't log "never retrieved"
+
+ADMISSION = AdmissionControl(MAX_IN_FLIGHT, MAX_BULK_IN_FLIGHT)
+ADMISSIONS_TOTAL = Counter("bjv_admissions_total", "Analysis admission decisions by outcome and quality tier", ("outcome", "tier"))
+METRICS.extend([
+    ADMISSIONS_TOTAL,
+    Gauge("bjv_analyses_in_flight", "Analyses running or queued on the analysis pool", lambda: ADMISSION.in_flight),
+    Gauge("bjv_bulk_analyses_in_flight", "Batch and background analyses among them", lambda: ADMISSION.bulk_in_flight),
+    Gauge("bjv_analyses_waiting", "Batch and background analyses waiting for an admission slot", lambda: len(ADMISSION.waiters)),
+])
+
+# === Result cache ===
+class ResultCache:
+    """
+    LRU cache of analysis results with a per-entry TTL and a total byte budget
+    (entry size is estimated from the JSON size of the result). Entries stored with a
+    perceptual thumbnail are also found by near matches (nearest). Only used from the
+    event loop, so it needs no locking.
+    """
+
+    ENTRY_OVERHEAD = 256  # rough per-entry bookkeeping bytes
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, size, result)
+        self.thumbnails = {}  # key -> (bucket, thumbnail) for perceptual entries
+        self.buckets = {}  # (key prefix, brightness level) -> keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _remove(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+        if key in self.thumbnails:
+            bucket, _ = self.thumbnails.pop(key)
+            self.buckets[bucket].discard(key)
+            if not self.buckets[bucket]:
+                del self.buckets[bucket]
+
+    @staticmethod
+    def _bucket(key: str, thumbnail: np.ndarray) -> tuple:
+        """Entries are compared within the same pipeline/players/tier prefix and similar overall brightness"""
+        return key.rsplit(":", 1)[0], int(thumbnail.mean()) // PERCEPTUAL_MAX_DIFFERENCE
+
+    def nearest(self, key: str, thumbnail: np.ndarray) -> Optional[str]:
+        """
+        Key of the stored entry whose thumbnail differs least from 'thumbnail', as the largest
+        per-pixel difference, if that is at most PERCEPTUAL_MAX_DIFFERENCE. Noise, re-encoding
+        and small camera shifts stay well under it; a card dealt or swapped goes well over.
+        """
+        prefix, level = self._bucket(key, thumbnail)
+        best, best_difference = None, PERCEPTUAL_MAX_DIFFERENCE + 1
+        for probe in (level - 1, level, level + 1):
+            for candidate in self.buckets.get((prefix, probe), ()):
+                difference = int(cv2.absdiff(self.thumbnails[candidate][1], thumbnail).max())
+                if difference < best_difference:
+                    best, best_difference = candidate, difference
+        return best
+
+    def get(self, key: str, thumbnail: np.ndarray = None) -> Optional[dict]:
+        if thumbnail is not None and key not in self.entries:
+            key = self.nearest(key, thumbnail) or key
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            RESULT_CACHE_LOOKUPS.inc("miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        RESULT_CACHE_LOOKUPS.inc("hit")
+        return entry[2]
+
+    def put(self, key: str, result: dict, thumbnail: np.ndarray = None):
+        size = len(json.dumps(result)) + len(key) + self.ENTRY_OVERHEAD
+        if thumbnail is not None:
+            size += thumbnail.nbytes
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, result)
+        if thumbnail is not None:
+            bucket = self._bucket(key, thumbnail)
+            self.thumbnails[key] = (bucket, thumbnail)
+            self.buckets.setdefault(bucket, set()).add(key)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self) -> dict:
+        return {
+            "mode": RESULT_CACHE_MODE,
+            "entries": len(self),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+        }
+
+def perceptual_thumbnail(image_data: bytes) -> Optional[np.ndarray]:
+    """
+    Grayscale thumbnail of a 1/8-scale decode, for ResultCache.nearest: averaging over
+    each thumbnail pixel cancels sensor noise and JPEG artifacts, while a card covers
+    several thumbnail pixels. None for images decode_image would reject as unsupported;
+    raises UploadTooLarge, like decode_image, before decoding one over MAX_IMAGE_PIXELS.
+    """
+    size = read_image_size(image_data)
+    if size is None:
+        return None
+    check_image_pixels(size)
+    gray = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+    return cv2.resize(gray, (PERCEPTUAL_THUMBNAIL_SIZE, PERCEPTUAL_THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+
+def result_cache_key(image_data: bytes, players: int, tier: str = "full") -> Tuple[Optional[str], Optional[np.ndarray]]:
+    """
+    Cache key for an upload: pipeline and template bank versions, players, quality tier and
+    a content hash, plus in perceptual mode the thumbnail near matches are looked up by
+    """
+    thumbnail = None
+    if RESULT_CACHE_MODE == "perceptual":
+        thumbnail = perceptual_thumbnail(image_data)
+        if thumbnail is None:
+            return None, None
+        digest = hashlib.sha256(thumbnail.tobytes()).hexdigest()
+    else:
+        digest = hashlib.sha256(image_data).hexdigest()
+    return f"{PIPELINE_VERSION}:{template_bank_version()}:{players}:{tier}:{RESULT_CACHE_MODE}:{digest}", thumbnail
+
+async def cached_analysis(image_data: bytes, players: int, priority: str = "interactive") -> Tuple[dict, dict, bool]:
+    """
+    Admission-controlled timed_analysis behind the result cache; returns (results, stage
+    timings, cache hit). The quality tier is part of the cache key, so degraded results
+    are never served to a request that would have run at full quality; lookups use the
+    tier the current load would get.
+    """
+    tier = "full" if priority == "background" else ADMISSION.tier()
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        results, timings = await ADMISSION.run(image_data, players, priority)
+        return results, timings, False
+
+    # Hashing a large upload (or decoding it for the perceptual thumbnail) would stall the event loop
+    if RESULT_CACHE_MODE == "perceptual" or len(image_data) > 256 * 1024:
+        key, thumbnail = await asyncio.to_thread(result_cache_key, image_data, players, tier)
+    else:
+        key, thumbnail = result_cache_key(image_data, players, tier)
+    if key is not None:
+        cached = RESULT_CACHE.get(key, thumbnail)
+        if cached is not None:
+            return cached, {}, True
+
+    results, timings = await ADMISSION.run(image_data, players, priority)
+    if key is not None and results["quality"] == tier:
+        RESULT_CACHE.put(key, results, thumbnail)
+    return results, timings, False
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+RESULT_CACHE_LOOKUPS = Counter("bjv_result_cache_lookups_total", "Result cache lookups by outcome", ("outcome",))
+METRICS.extend([
+    RESULT_CACHE_LOOKUPS,
+    Gauge("bjv_result_cache_hit_ratio", "Result cache hits / lookups since start", lambda: RESULT_CACHE.hit_rate),
+    Gauge("bjv_result_cache_entries", "Entries in the result cache", lambda: len(RESULT_CACHE)),
+    Gauge("bjv_result_cache_bytes", "Estimated bytes held by the result cache", lambda: RESULT_CACHE.size),
+])
+
+@app.get("/debug/cache")
+async def debug_cache():
+    return RESULT_CACHE.stats()
+
+@app.post("/analyze/")
+async def analyze_image(file: UploadFile = File(...), players: int = Form(...), session_id: str = Form(None)):
+    request_start = time.perf_counter()
+    status = 500
+    if session_id is not None and not valid_session_id(session_id):
+        status = 400
+        record_request("analyze", status, request_start)
+        return JSONResponse(status_code=400, content={"error": "Invalid session id"})
+    if players not in PLAYER_COUNTS:
+        status = 400
+        record_request("analyze", status, request_start)
+        return JSONResponse(status_code=400, content={"error": PLAYERS_ERROR})
+    try:
+        image_data = await read_upload(file)
+        logger.debug("upload content_type=%s bytes=%d", file.content_type, len(image_data))
+        
+        results, timings, cache_hit = await cached_analysis(image_data, players)
+        record_stage_timings(timings)
+        if session_id is not None:
+            results = await observe_in_session(results, SESSIONS.get(session_id, create=True))
+        status = 200
+        total = time.perf_counter() - request_start
+        server_timing = server_timing_header(timings, total) + f', cache;desc={"hit" if cache_hit else "miss"}'
+        server_timing += f', quality;desc={results["quality"]}'
+        return JSONResponse(content=results, headers={"Server-Timing": server_timing})
     
+    except ImageDecodeError as e:
+        status = 400
+        return JSONResponse(
+            status_code=400, 
+            content={"error": str(e)}
+        )
+    except UploadTooLarge as e:
+        status = 413
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except OverloadedError as e:
+        status = 503
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "1"})
+    except DeadlineExceeded as e:
+        status = 504
+        return JSONResponse(status_code=504, content={"error": str(e)})
     except Exception as e:
-        print(f"Error processing image: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("error processing image: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": f"Error processing image: {str(e)}"}
         )
+    finally:
+        record_request("analyze", status, request_start)
+
+# === Batch analysis ===
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+
+def read_image_archive(archive_data: bytes, max_images: int = BATCH_MAX_IMAGES,
+                       max_bytes: int = MAX_BATCH_BYTES) -> List[Tuple[str, bytes]]:
+    """
+    Extract image members from a zip or tar archive, sorted by member name. Raises
+    UploadTooLarge before inflating anything (going by the recorded member sizes) when a
+    member is over MAX_UPLOAD_BYTES, there are over max_images of them or they add up to
+    over max_bytes. Blocking; run it off the event loop.
+    """
+    buffer = io.BytesIO(archive_data)
+
+    def check_members(members):
+        """members: (name, recorded size, member) of the image entries"""
+        if len(members) > max_images:
+            raise UploadTooLarge(f"Archive has {len(members)} images, limit is {max_images}")
+        for name, size, _ in members:
+            if size > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(f"Archive member {name} is {size} bytes, limit is {MAX_UPLOAD_BYTES}")
+        total = sum(size for _, size, _ in members)
+        if total > max_bytes:
+            raise UploadTooLarge(f"Archive images add up to {total} bytes, limit is {max_bytes}")
+
+    if zipfile.is_zipfile(buffer):
+        with zipfile.ZipFile(buffer) as zf:
+            members = [(info.filename, info.file_size, info) for info in zf.infolist()
+                       if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+            check_members(members)
+            # ZipExtFile stops at the recorded file_size, so that bounds what is inflated
+            images = [(name, zf.read(info)) for name, _, info in members]
+    else:
+        buffer.seek(0)
+        try:
+            with tarfile.open(fileobj=buffer, mode="r:*") as tf:
+                members = [(member.name, member.size, member) for member in tf.getmembers()
+                           if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS)]
+                check_members(members)
+                images = [(name, tf.extractfile(member).read()) for name, _, member in members]
+        except tarfile.TarError:
+            raise ValueError("Archive is neither a zip nor a tar file")
+    images.sort(key=lambda item: item[0])
+    return images
+
+async def analyze_batch_item(index: int, filename: str, image_data: bytes, players: int, priority: str = "batch") -> dict:
+    """Analyze one batch entry, turning failures into a per-item error instead of failing the batch"""
+    item = {"index": index, "filename": filename, "players": players}
+    try:
+        item["result"], timings, item["cached"] = await cached_analysis(image_data, players, priority)
+        record_stage_timings(timings)
+    except ImageDecodeError as e:
+        item["error"] = str(e)
+        item["status"] = 400
+    except UploadTooLarge as e:
+        item["error"] = str(e)
+        item["status"] = 413
+    except DeadlineExceeded as e:
+        item["error"] = str(e)
+        item["status"] = 504
+    except Exception as e:
+        logger.exception("error processing batch image index=%d filename=%s", index, filename)
+        item["error"] = f"Error processing image: {str(e)}"
+        item["status"] = 500
+    return item
+
+async def read_batch_uploads(files: Optional[List[UploadFile]], archive: Optional[UploadFile], players: List[int]):
+    """
+    Collect (filename, bytes) images from uploaded files and an archive, with one players
+    value per image. Returns (images, players), or (error response, None) for a bad upload.
+    """
+    if not all(p in PLAYER_COUNTS for p in players):
+        return JSONResponse(status_code=400, content={"error": PLAYERS_ERROR}), None
+    images = []
+    try:
+        for upload in files or []:
+            images.append((upload.filename, await read_upload(upload)))
+        if archive is not None:
+            archive_data = await read_upload(archive, MAX_BATCH_BYTES, image=False)
+            images.extend(await asyncio.to_thread(
+                read_image_archive, archive_data, BATCH_MAX_IMAGES - len(images), MAX_BATCH_BYTES
+            ))
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)}), None
+    except (ValueError, zipfile.BadZipFile) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)}), None
+
+    if not images:
+        return JSONResponse(status_code=400, content={"error": "No images provided"}), None
+    if len(images) > BATCH_MAX_IMAGES:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Batch has {len(images)} images, limit is {BATCH_MAX_IMAGES}"}
+        ), None
+    if len(players) == 1:
+        players = players * len(images)
+    elif len(players) != len(images):
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Got {len(players)} players values for {len(images)} images"}
+        ), None
+    return images, players
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    players: List[int] = Form([1]),
+    stream: bool = Form(False),
+):
+    """
+    Analyze many images in one request, given as multipart 'files' and/or a zip/tar 'archive'.
+    'players' is either one value for every image or one value per image (archive members
+    follow the uploaded files, in member-name order). Images are processed in parallel on
+    the analysis pool; results come back in input order, or as NDJSON lines in completion
+    order when 'stream' is set.
+    """
+    request_start = time.perf_counter()
+    images, players = await read_batch_uploads(files, archive, players)
+    if isinstance(images, JSONResponse):
+        return images
+
+    logger.info("batch images=%d", len(images))
+    tasks = [
+        asyncio.ensure_future(analyze_batch_item(i, filename, data, p))
+        for i, ((filename, data), p) in enumerate(zip(images, players))
+    ]
+
+    if stream:
+        async def ndjson_lines():
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield json.dumps(await next_done) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+                record_request("batch", 200, request_start)
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    results = await asyncio.gather(*tasks)
+    record_request("batch", 200, request_start)
+    return JSONResponse(content={"results": results, "total": len(results)})
+
+# === Jobs ===
+class Job:
+    """One queued batch analysis and, once finished, its result"""
+    __slots__ = ("id", "images", "players", "status", "result", "error", "created", "started", "finished", "done")
+
+    def __init__(self, images: List[Tuple[str, bytes]], players: List[int]):
+        self.id = uuid.uuid4().hex
+        self.images = images
+        self.players = players
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        body = {"id": self.id, "status": self.status, "created": self.created,
+                "started": self.started, "finished": self.finished}
+        if self.result is not None:
+            body["result"] = self.result
+        if self.error is not None:
+            body["error"] = self.error
+        return body
+
+class JobQueue:
+    """
+    Bounded queue of analysis jobs drained by a fixed number of worker tasks. Bounded both
+    by job count and by the image bytes its queued and running jobs hold ('max_bytes').
+    Finished jobs are kept for 'ttl' seconds so clients can fetch them, then dropped.
+    """
+
+    def __init__(self, maxsize: int, concurrency: int, ttl: float, max_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bytes = 0  # image bytes of jobs not finished yet
+        self.concurrency = max(1, concurrency)
+        self.ttl = ttl
+        self.jobs = {}
+        self.queue = None
+        self.workers = []
+        self.running = 0
+        self.job_seconds = 1.0  # moving average, for Retry-After estimates
+
+    def start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self.workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def full(self) -> bool:
+        """No room for another job, whatever its size; checked before an upload is read"""
+        return self.queue.full() or self.bytes >= self.max_bytes
+
+    def submit(self, images: List[Tuple[str, bytes]], players: List[int]) -> Optional[Job]:
+        """Queue a job, or return None when the queue is full or the images would not fit in max_bytes"""
+        self.expire()
+        size = sum(len(data) for _, data in images)
+        if self.bytes and self.bytes + size > self.max_bytes:
+            return None
+        job = Job(images, players)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return None
+        self.bytes += size
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.expire()
+        return self.jobs.get(job_id)
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self.jobs.items() if job.finished is not None and job.finished < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if expired:
+            JOBS_TOTAL.inc("expired", amount=len(expired))
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained by one concurrency's worth of jobs"""
+        return max(1, math.ceil(self.depth * self.job_seconds / self.concurrency))
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            job.status = "running"
+            job.started = time.time()
+            self.running += 1
+            try:
+                items = await asyncio.gather(*(
+                    analyze_batch_item(i, filename, data, p, "background")
+                    for i, ((filename, data), p) in enumerate(zip(job.images, job.players))
+                ))
+                job.result = {"results": items, "total": len(items)}
+                job.status = "done"
+            except Exception as e:
+                logger.exception("job failed id=%s", job.id)
+                job.error = f"Error processing job: {str(e)}"
+                job.status = "failed"
+            finally:
+                self.running -= 1
+                job.finished = time.time()
+                self.bytes -= sum(len(data) for _, data in job.images)
+                job.images = None  # the result is all a client can still ask for
+                job.done.set()
+                self.queue.task_done()
+            self.job_seconds = 0.8 * self.job_seconds + 0.2 * (job.finished - job.started)
+            JOBS_TOTAL.inc(job.status)
+            logger.info("job finished id=%s status=%s seconds=%.3f", job.id, job.status, job.finished - job.started)
+
+JOBS = JobQueue(JOB_QUEUE_SIZE, JOB_CONCURRENCY, JOB_TTL, JOB_QUEUE_BYTES)
+JOBS_TOTAL = Counter("bjv_jobs_total", "Jobs by outcome", ("outcome",))
+METRICS.extend([
+    JOBS_TOTAL,
+    Gauge("bjv_job_queue_depth", "Jobs waiting in the job queue", lambda: JOBS.depth),
+    Gauge("bjv_jobs_running", "Jobs being processed", lambda: JOBS.running),
+    Gauge("bjv_job_queue_bytes", "Image bytes held by queued and running jobs", lambda: JOBS.bytes),
+    Gauge("bjv_jobs_stored", "Queued, running and finished-but-unexpired jobs", lambda: len(JOBS.jobs)),
+])
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    players: List[int] = Form([1]),
+):
+    """
+    Queue the same input as /analyze/batch and return a job id right away; fetch the
+    result from GET /jobs/{id}. Answers 429 with Retry-After when the queue is full, before
+    reading the upload when it already is.
+    """
+    request_start = time.perf_counter()
+    job = None
+    if not JOBS.full():
+        images, players = await read_batch_uploads(files, archive, players)
+        if isinstance(images, JSONResponse):
+            record_request("jobs", images.status_code, request_start)
+            return images
+        job = JOBS.submit(images, players)
+    if job is None:
+        JOBS_TOTAL.inc("rejected")
+        record_request("jobs", 429, request_start)
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Job queue is full"},
+            headers={"Retry-After": str(JOBS.retry_after())}
+        )
+    logger.info("job queued id=%s images=%d depth=%d", job.id, len(images), JOBS.depth)
+    record_request("jobs", 202, request_start)
+    return JSONResponse(status_code=202, content=job.to_dict(), headers={"Location": f"/jobs/{job.id}"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Job status and, once done, its result; 'wait' long-polls up to that many seconds for it to finish"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    if wait > 0 and not job.done.is_set():
+        try:
+            await asyncio.wait_for(job.done.wait(), min(wait, JOB_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+    return job.to_dict()
+
+# === Table tracking ===
+class TrackedCard:
+    """A card known from an earlier frame of the same table, with the rank it was classified as"""
+    __slots__ = ("region", "bbox", "rank", "signature")
+
+    def __init__(self, region: str, bbox: Tuple[int, int, int, int], rank: str, signature: np.ndarray):
+        self.region = region
+        self.bbox = bbox
+        self.rank = rank
+        self.signature = signature
+
+def bbox_iou(a: tuple, b: tuple) -> float:
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+def card_signature(gray: np.ndarray, bbox: tuple) -> np.ndarray:
+    """Tiny grayscale patch of a card's bounding box; cheap enough to compute for every card every frame"""
+    x, y, w, h = bbox
+    patch = gray[max(y, 0):y + h, max(x, 0):x + w]
+    if patch.size == 0:
+        return np.zeros(TRACK_SIGNATURE_SIZE[::-1], dtype=np.uint8)
+    return cv2.resize(patch, TRACK_SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+
+def hand_delta(before: dict, after: dict, hands) -> List[dict]:
+    """Cards added to and removed from each hand between two {hand: ranks} states, as multiset differences"""
+    delta = []
+    for hand in hands:
+        added = list(after.get(hand, []))
+        for rank in before.get(hand, []):
+            if rank in added:
+                added.remove(rank)
+            else:
+                delta.append({"hand": hand, "card": rank, "change": "removed"})
+        delta.extend({"hand": hand, "card": rank, "change": "added"} for rank in added)
+    return delta
+
+def track_cards(image: np.ndarray, players: int, known: List[TrackedCard], timings: "StageTimings" = None,
+                detection_size: int = None, mode: str = None) -> Tuple[dict, List[TrackedCard], List[dict]]:
+    """
+    Detect the cards in a frame and pair them with the cards known from the
+    previous frame: same region, bounding boxes overlapping by at least
+    TRACK_IOU_THRESHOLD (best overlap first) and a signature that has not
+    changed by more than TRACK_CHANGE_THRESHOLD. Paired cards keep their rank;
+    only new, moved or swapped cards are warped and matched, a moved card with
+    its old rank as the prior.
+    Returns (results, cards now known, delta events such as
+    {"hand": "player1", "card": "King", "change": "added"}).
+    """
+    timings = timings if timings is not None else StageTimings()
+    detections = detect_and_classify_cards(image, players, timings, detection_size)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    signatures = [card_signature(gray, card.bbox) for card in detections]
+
+    # Greedy pairing, highest overlap first
+    pairs = sorted(
+        ((bbox_iou(card.bbox, old.bbox), i, j)
+         for i, card in enumerate(detections) for j, old in enumerate(known) if card.region == old.region),
+        reverse=True,
+    )
+    ranks = [None] * len(detections)
+    priors = [None] * len(detections)
+    paired_known = set()
+    for iou, i, j in pairs:
+        if iou < TRACK_IOU_THRESHOLD:
+            break
+        if ranks[i] is not None or priors[i] is not None or j in paired_known:
+            continue
+        paired_known.add(j)
+        change = float(np.mean(cv2.absdiff(signatures[i], known[j].signature)))
+        if change <= TRACK_CHANGE_THRESHOLD:
+            ranks[i] = known[j].rank
+        else:
+            priors[i] = known[j].rank  # Swapped or partly covered; reclassify, the old rank is still the best guess
+    # Moved cards: the known card they overlap most is the cascade prior
+    for iou, i, j in pairs:
+        if iou > 0 and ranks[i] is None and priors[i] is None and j not in paired_known:
+            priors[i] = known[j].rank
+
+    pending = [i for i in range(len(detections)) if ranks[i] is None]
+    if pending:
+        warped = warp_cards(image, [detections[i] for i in pending], timings)
+        classify = [i for i, card in zip(pending, warped) if card is not None]
+        classified = classify_cards([card for card in warped if card is not None], get_template_bank(), timings,
+                                    mode=mode, priors=[priors[i] for i in classify])
+        for i, rank in zip(classify, classified):
+            ranks[i] = rank
+    logger.debug("tracked cards=%d reused=%d classified=%d", len(detections), len(detections) - len(pending), len(pending))
+
+    start = time.perf_counter()
+    tracked = [
+        TrackedCard(card.region, card.bbox, rank, signature)
+        for card, rank, signature in zip(detections, ranks, signatures) if rank is not None
+    ]
+    hands = {region: [card.rank for card in tracked if card.region == region] for region in REGIONS}
+    before = {region: [card.rank for card in known if card.region == region] for region in REGIONS}
+    delta = hand_delta(before, hands, REGIONS[:players + 1])
+    results = hand_results(hands, players)
+    timings.lap("score", start)
+    return results, tracked, delta
+
+# === Table sessions ===
+HI_LO = (-1, 1, 1, 1, 1, 1, 0, 0, 0, -1)  # Running-count tag per card value (Ace, 2..9, ten-valued)
+SESSION_ID_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_")
+
+class TableSession:
+    """
+    Shoe state of one table: cards left per value, Hi-Lo running count and the cards
+    counted in each hand this round. observe() only counts the cards a hand shows beyond
+    those, so re-analyzing the same round, or a card that comes back after a frame that
+    missed it, is not counted twice. The round ends when every hand is empty.
+    """
+    __slots__ = ("id", "decks", "counts", "running_count", "cards_seen", "hands", "updated")
+
+    def __init__(self, session_id: str, decks: int = None):
+        self.id = session_id
+        self.shuffle(decks)
+
+    def shuffle(self, decks: int = None):
+        self.decks = decks or SHOE_DECKS
+        self.counts = list(shoe_composition(decks=self.decks))
+        self.running_count = 0
+        self.cards_seen = 0
+        self.hands = {}
+        self.updated = time.time()
+
+    def observe(self, results: dict) -> List[str]:
+        """Take the cards not yet counted this round out of the shoe; returns those ranks"""
+        hands = {hand: results[hand]["cards"] for hand in REGIONS if hand in results}
+        if not any(hands.values()):
+            self.hands = {}  # table cleared: a new round starts
+        added = []
+        for hand, cards in hands.items():
+            counted = list(self.hands.get(hand, []))
+            for rank in cards:
+                if rank in counted:
+                    counted.remove(rank)  # each counted card accounts for one shown card
+                else:
+                    added.append(rank)
+                    self.hands[hand] = self.hands.get(hand, []) + [rank]
+        for rank in added:
+            value = CARD_VALUES.get(rank)
+            if value is not None and self.counts[value - 1] > 0:
+                self.counts[value - 1] -= 1
+                self.running_count += HI_LO[value - 1]
+                self.cards_seen += 1
+        self.updated = time.time()
+        return added
+
+    @property
+    def composition(self) -> Tuple[int, ...]:
+        return tuple(self.counts)
+
+    def summary(self) -> dict:
+        remaining = sum(self.counts)
+        decks_left = remaining / 52
+        return {
+            "id": self.id,
+            "decks": self.decks,
+            "cards_seen": self.cards_seen,
+            "cards_remaining": remaining,
+            "running_count": self.running_count,
+            "true_count": round(self.running_count / decks_left, 2) if decks_left else 0.0,
+            "composition": dict(zip(("Ace", "2", "3", "4", "5", "6", "7", "8", "9", "10"), self.counts)),
+        }
+
+    def row(self) -> tuple:
+        return (self.id, self.decks, json.dumps(self.counts), self.running_count, self.cards_seen,
+                json.dumps(self.hands), self.updated)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "TableSession":
+        session = cls.__new__(cls)
+        (session.id, session.decks, counts, session.running_count, session.cards_seen, hands, session.updated) = row
+        session.counts, session.hands = json.loads(counts), json.loads(hands)
+        return session
+
+class SessionStore:
+    """
+    Table sessions held in memory and written to SQLite in batches: changed sessions are
+    marked dirty and flushed together every SESSION_FLUSH_INTERVAL seconds (and on
+    shutdown), so a restarted worker recovers them with at most that much lost.
+    Sessions idle for SESSION_TTL seconds are dropped.
+    """
+
+    def __init__(self, path: str, flush_interval: float, ttl: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.sessions = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.flusher = None
+
+    def start(self):
+        self.sessions = {row[0]: TableSession.from_row(row) for row in self._load()}
+        logger.info("table sessions recovered count=%d path=%s", len(self.sessions), self.path)
+        self.flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
+
+    def get(self, session_id: str, create: bool = False) -> Optional[TableSession]:
+        session = self.sessions.get(session_id)
+        if session is None and create:
+            session = self.sessions[session_id] = TableSession(session_id)
+            self.deleted.discard(session_id)
+            self.dirty.add(session_id)
+        return session
+
+    def touch(self, session: TableSession):
+        self.dirty.add(session.id)
+
+    def delete(self, session_id: str) -> bool:
+        if self.sessions.pop(session_id, None) is None:
+            return False
+        self.dirty.discard(session_id)
+        self.deleted.add(session_id)
+        return True
+
+    async def flush(self):
+        cutoff = time.time() - self.ttl
+        for session_id in [sid for sid, session in self.sessions.items() if session.updated < cutoff]:
+            self.delete(session_id)
+        if not self.dirty and not self.deleted:
+            return
+        rows = [self.sessions[session_id].row() for session_id in self.dirty]
+        deleted = list(self.deleted)
+        self.dirty, self.deleted = set(), set()
+        try:
+            await asyncio.to_thread(self._write, rows, deleted)
+        except sqlite3.Error:
+            logger.exception("table session flush failed path=%s", self.path)
+            self.dirty.update(row[0] for row in rows if row[0] in self.sessions)
+            self.deleted.update(deleted)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS table_sessions (id TEXT PRIMARY KEY, decks INTEGER, counts TEXT,"
+            " running_count INTEGER, cards_seen INTEGER, hands TEXT, updated REAL)"
+        )
+        return db
+
+    def _load(self) -> List[tuple]:
+        try:
+            with closing(self._connect()) as db:
+                return db.execute("SELECT id, decks, counts, running_count, cards_seen, hands, updated"
+                                  " FROM table_sessions WHERE updated >= ?", (time.time() - self.ttl,)).fetchall()
+        except sqlite3.Error:
+            logger.exception("could not load table sessions path=%s", self.path)
+            return []
+
+    def _write(self, rows: List[tuple], deleted: List[str]):
+        with closing(self._connect()) as db, db:
+            db.executemany("INSERT OR REPLACE INTO table_sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            db.executemany("DELETE FROM table_sessions WHERE id = ?", [(session_id,) for session_id in deleted])
+        logger.debug("table sessions flushed written=%d deleted=%d", len(rows), len(deleted))
+
+def valid_session_id(session_id: str) -> bool:
+    return 0 < len(session_id) <= 64 and set(session_id) <= SESSION_ID_CHARS
+
+async def observe_in_session(results: dict, session: TableSession) -> dict:
+    """
+    Let a table session observe an analysis result; returns a copy of the result with
+    player odds recomputed against the session's remaining shoe and a "session" summary
+    """
+    session.observe(results)
+    SESSIONS.touch(session)
+    results = dict(results, session=session.summary())
+    composition = session.composition
+    if sum(composition):
+        players = [hand for hand in REGIONS[1:] if hand in results]
+        # A composition not seen before costs a few milliseconds of dynamic programming
+        odds = await asyncio.to_thread(lambda: [
+            evaluate_hand(results["dealer"]["cards"], results[hand]["cards"], composition) for hand in players
+        ])
+        for hand, hand_odds in zip(players, odds):
+            results[hand] = dict(results[hand], odds=hand_odds)
+    return results
+
+SESSIONS = SessionStore(SESSION_DB_PATH, SESSION_FLUSH_INTERVAL, SESSION_TTL)
+METRICS.append(Gauge("bjv_table_sessions", "Table sessions held in memory", lambda: len(SESSIONS.sessions)))
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = SESSIONS.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown table session"})
+    return session.summary()
+
+@app.post("/sessions/{session_id}/shuffle")
+async def shuffle_session(session_id: str, decks: int = Form(None)):
+    """Start a fresh shoe for a table session, creating the session if needed"""
+    if not valid_session_id(session_id) or (decks is not None and decks <= 0):
+        return JSONResponse(status_code=400, content={"error": "Invalid session id or decks"})
+    session = SESSIONS.get(session_id, create=True)
+    session.shuffle(decks)
+    SESSIONS.touch(session)
+    return session.summary()
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not SESSIONS.delete(session_id):
+        return JSONResponse(status_code=404, content={"error": "Unknown table session"})
+    return {"id": session_id, "deleted": True}
+
+# === Live stream ===
+def frame_thumbnail(image: np.ndarray) -> np.ndarray:
+    """Tiny grayscale version of a frame, used to tell whether the table changed"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, LIVE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+def analyze_live_frame(image_data: bytes, players: int, tier: str, deadline: Optional[float],
+                       thumbnail, last_result, known: List[TrackedCard]) -> tuple:
+    """
+    Analyze one streamed frame at a quality tier, reusing the previous result when the
+    frame is visually unchanged since the last analyzed one; otherwise the cards known
+    from earlier frames are tracked (track_cards) and only new ones classified.
+    Like timed_analysis, skips the work when it only gets to run after the deadline.
+    Returns (result, thumbnail of the analyzed frame, reused, stage timings,
+    cards now known, delta).
+    """
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded("Analysis deadline passed before it started")
+    max_dimension, detection_size, mode = tier_settings(tier)
+    timings = StageTimings()
+    image = decode_image(image_data, timings, max_dimension)
+    thumb = frame_thumbnail(image)
+    if thumbnail is not None and last_result is not None and thumb.shape == thumbnail.shape:
+        change = float(np.mean(cv2.absdiff(thumb, thumbnail)))
+        if change < LIVE_CHANGE_THRESHOLD:
+            return last_result, thumbnail, True, timings, known, []
+    result, tracked, delta = track_cards(image, players, known, timings, detection_size, mode)
+    result["quality"] = tier
+    return result, thumb, False, timings, tracked, delta
+
+class LiveSession:
+    """
+    Per-connection state for /ws/live. Only the newest received frame is kept:
+    a frame that arrives while another is still waiting replaces it (and is
+    counted as dropped), so the client always gets results for the latest view.
+    """
+
+    def __init__(self, players: int = 1, table: "TableSession" = None):
+        self.players = players
+        self.table = table  # table session that observes each result, if any
+        self.pending = None  # (sequence number, frame bytes, receive time)
+        self.frame_ready = asyncio.Event()
+        self.received = 0
+        self.dropped = 0
+        self.thumbnail = None
+        self.last_result = None
+        self.tracked = []  # TrackedCard list of the last analyzed frame
+
+    def offer(self, frame: bytes):
+        self.received += 1
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = (self.received, frame, time.perf_counter())
+        self.frame_ready.set()
+
+    def take(self) -> tuple:
+        frame, self.pending = self.pending, None
+        self.frame_ready.clear()
+        return frame
+
+    def configure(self, players: int):
+        if players != self.players:
+            self.players = players
+            self.thumbnail = None
+            self.last_result = None
+            self.tracked = []
+
+async def process_live_frames(websocket: WebSocket, session: LiveSession):
+    """Analyze the latest pending frame of a session whenever one is available"""
+    while True:
+        await session.frame_ready.wait()
+        seq, frame, received_at = session.take()
+        players = session.players
+        try:
+            result, thumbnail, reused, timings, tracked, delta = await ADMISSION.run(
+                frame, players, "live", analyze_live_frame, (session.thumbnail, session.last_result, session.tracked)
+            )
+            record_stage_timings(timings)
+            if players == session.players:
+                session.thumbnail, session.last_result, session.tracked = thumbnail, result, tracked
+            if session.table is not None:
+                result = await observe_in_session(result, session.table)
+            payload = {"frame": seq, "result": result, "delta": delta, "reused": reused}
+            status = 200
+        except OverloadedError:
+            session.dropped += 1  # the stream's next frame gets the next free slot
+            payload = {"frame": seq, "error": "Server is busy, frame dropped"}
+            status = 503
+        except DeadlineExceeded as e:
+            payload = {"frame": seq, "error": str(e)}
+            status = 504
+        except ImageDecodeError as e:
+            payload = {"frame": seq, "error": str(e)}
+            status = 400
+        except UploadTooLarge as e:
+            payload = {"frame": seq, "error": str(e)}
+            status = 413
+        except Exception as e:
+            logger.exception("error processing live frame=%d", seq)
+            payload = {"frame": seq, "error": f"Error processing image: {str(e)}"}
+            status = 500
+        record_request("live", status, received_at)
+        payload["dropped"] = session.dropped
+        payload["latency_ms"] = round((time.perf_counter() - received_at) * 1000, 1)
+        await websocket.send_json(payload)
+
+@app.websocket("/ws/live")
+async def live_stream(websocket: WebSocket, players: int = 1, session_id: str = None):
+    """
+    Stream encoded frames (binary messages) and receive one JSON result per processed frame.
+    A text message {"players": 1|2} changes the layout mid-stream. With session_id, every
+    result also updates that table session.
+    """
+    if (session_id is not None and not valid_session_id(session_id)) or players not in PLAYER_COUNTS:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    session = LiveSession(players, SESSIONS.get(session_id, create=True) if session_id is not None else None)
+    processor = asyncio.create_task(process_live_frames(websocket, session))
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if len(message["bytes"]) > MAX_UPLOAD_BYTES:
+                    await websocket.send_json({"error": f"Frame is over the {MAX_UPLOAD_BYTES} byte limit"})
+                else:
+                    session.offer(message["bytes"])
+            elif message.get("text"):
+                try:
+                    players = int(json.loads(message["text"])["players"])
+                    if players not in PLAYER_COUNTS:
+                        raise ValueError(PLAYERS_ERROR)
+                    session.configure(players)
+                except (ValueError, KeyError, TypeError):
+                    await websocket.send_json({"error": 'Expected {"players": 1 or 2}'})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        processor.cancel()
 
 # === Server Startup ===
 if __name__ == "__main__":
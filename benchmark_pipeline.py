@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Offline micro-benchmark for the recognition pipeline.
+
+Calls the backend pipeline functions directly (no server needed) on synthetic
+blackjack scenes across image resolutions, card counts and player modes, and
+writes per-stage latency, allocation and accuracy numbers as JSON so two
+commits can be compared:
+
+    python3 benchmark_pipeline.py --output before.json
+    git checkout <other commit>
+    python3 benchmark_pipeline.py --output after.json
+    python3 benchmark_pipeline.py --compare before.json after.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+BACKEND_PATH = os.path.join(REPO_ROOT, "backend")
+CARDS_PATH = os.path.join(BACKEND_PATH, "Cards")
+
+os.environ.setdefault("BJV_LOG_LEVEL", "WARNING")
+sys.path.insert(0, BACKEND_PATH)
+import main
+
+
+def add_clutter(scene, count, rng, keep_out=()):
+    """
+    Scatter chips and table text over the felt, each one a few small contours.
+    Nothing is drawn near the keep_out (x, y, w, h) rectangles, so the cards'
+    outlines stay intact.
+    """
+    height, width = scene.shape[:2]
+    radius = max(height // 80, 3)
+    margin = radius * 4
+    drawn = attempts = 0
+    while drawn < count and attempts < count * 20:
+        attempts += 1
+        x, y = int(rng.integers(width)), int(rng.integers(height))
+        if any(rx - margin <= x <= rx + rw + margin and ry - margin <= y <= ry + rh + margin
+               for rx, ry, rw, rh in keep_out):
+            continue
+        drawn += 1
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.7:
+            cv2.circle(scene, (x, y), radius, color, -1)
+            cv2.circle(scene, (x, y), radius * 2 // 3, (255, 255, 255), max(radius // 4, 1))
+        else:
+            cv2.putText(scene, "PAYS 3 TO 2", (x, y), cv2.FONT_HERSHEY_SIMPLEX, radius / 12, color, max(radius // 6, 1))
+
+
+def create_synthetic_scene(width, height, num_cards, players, seed=0, clutter=0):
+    """
+    Synthetic table scene in the spirit of final_test.create_realistic_blackjack_scene:
+    green felt, dealer cards in the top half, player cards in the bottom half
+    (player 2 on the left, player 1 on the right in two-player mode).
+    Cards are dealt round-robin to dealer, player1[, player2]; clutter chips and
+    text snippets are then scattered over the free felt.
+    Returns (BGR scene, expected ranks per hand in left-to-right order).
+    """
+    rng = np.random.default_rng(seed)
+    scene = np.empty((height, width, 3), dtype=np.uint8)
+    scene[:, :] = [34, 139, 34]  # Forest green
+    noise = rng.normal(0, 4, scene.shape)
+    scene = np.clip(scene + noise, 0, 255).astype(np.uint8)
+
+    card_files = sorted(f for f in os.listdir(CARDS_PATH) if f.endswith(".png"))
+    hands = ["dealer", "player1"] + (["player2"] if players == 2 else [])
+    dealt = {hand: [] for hand in hands}
+    for i in range(num_cards):
+        dealt[hands[i % len(hands)]].append(card_files[rng.integers(len(card_files))])
+
+    # Card size proportional to the table, like the 90px cards on the 600px test scene
+    card_height = int(height * 0.2)
+    card_width = int(card_height * 0.69)
+    gap = card_width // 3
+
+    regions = {
+        "dealer": (0, width, 0, height // 2),
+        "player1": (0, width, height // 2, height) if players == 1 else (width // 2, width, height // 2, height),
+        "player2": (0, width // 2, height // 2, height),
+    }
+
+    expected = {}
+    placed = []
+    for hand, files in dealt.items():
+        x0, x1, y0, y1 = regions[hand]
+        x = x0 + gap
+        y = y0 + (y1 - y0 - card_height) // 2
+        expected[hand] = []
+        for card_file in files:
+            if x + card_width >= x1:
+                break  # no room left in this region
+            card = cv2.imread(os.path.join(CARDS_PATH, card_file), cv2.IMREAD_COLOR)
+            jitter = int(rng.integers(-gap // 4, gap // 4 + 1))
+            scene[y + jitter:y + jitter + card_height, x:x + card_width] = cv2.resize(card, (card_width, card_height))
+            placed.append((x, y + jitter, card_width, card_height))
+            expected[hand].append(card_file.split("_of_")[0].title())
+            x += card_width + gap
+
+    add_clutter(scene, clutter, rng, placed)
+    return scene, expected
+
+
+def summarize(samples_ms):
+    ordered = sorted(samples_ms)
+    return {
+        "median_ms": round(statistics.median(ordered), 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 3),
+        "min_ms": round(ordered[0], 3),
+    }
+
+
+def run_pipeline(image_data, players, timings, tier="full"):
+    """decode -> detect -> match -> score, mirroring analyze_image_bytes"""
+    return main.analyze_image_bytes(image_data, players, timings, tier)
+
+
+def measure_allocations(image_data, players):
+    """
+    Peak traced allocation (KiB) above the step's starting point for each coarse
+    pipeline step; OpenCV-internal buffers are not traced.
+    """
+    bank = main.get_template_bank()
+    peaks = {}
+
+    @contextlib.contextmanager
+    def step(name):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        yield
+        peaks[name] = tracemalloc.get_traced_memory()[1] - baseline
+
+    tracemalloc.start()
+    try:
+        with step("decode"):
+            image = main.decode_image(image_data)
+        with step("detect"):
+            detections = main.detect_and_classify_cards(image, players)
+        with step("warp"):
+            hands = [[warped for warped in main.warp_cards(image, [card for card in detections if card.region == region])
+                      if warped is not None]
+                     for region in main.REGIONS[:players + 1]]
+        with step("match"):
+            ranks = [main.match_cards_to_templates(cards, bank) for cards in hands]
+        with step("score"):
+            for hand_ranks in ranks:
+                main.calculate_score(hand_ranks)
+    finally:
+        tracemalloc.stop()
+    return {stage: round(peak / 1024, 1) for stage, peak in peaks.items()}
+
+
+def time_call(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(samples)
+
+
+def compare_matching(image_data, players, repeat, tolerance):
+    """
+    Agreement between exhaustive template scoring and the configured coarse-to-fine
+    pruning (MATCH_TOP_K) on the cards detected in this scene, plus how the
+    early-exit cascade (cold, and with the true ranks as priors), the corner
+    (rank index) matcher and the descriptor matcher (exact and approximate
+    nearest-neighbour search) compare to exhaustive scoring.
+    """
+    image = main.decode_image(image_data)
+    cards = [warped for warped in main.warp_cards(image, main.detect_and_classify_cards(image, players)) if warped is not None]
+    bank = main.get_template_bank()
+    if not cards:
+        return None
+
+    exhaustive, exhaustive_ms = time_call(lambda: bank.best_per_rank(bank.score_cards(cards, 0)), repeat)
+    pruned, pruned_ms = time_call(lambda: bank.best_per_rank(bank.score_cards(cards, main.MATCH_TOP_K)), repeat)
+    (cascade, cascade_evaluated), cascade_ms = time_call(lambda: bank.score_cascade(cards), repeat)
+    cascade = bank.best_per_rank(cascade)
+    truth = [bank.rank_names[i] for i in np.argmax(exhaustive, axis=1)]
+    primed_evaluated = bank.score_cascade(cards, truth)[1]
+    (descriptor, _), descriptor_ms = time_call(lambda: bank.score_descriptors(cards, approximate=False), repeat)
+    (approximate, _), approximate_ms = time_call(lambda: bank.score_descriptors(cards, approximate=True), repeat)
+    descriptor, approximate = bank.best_per_rank(descriptor), bank.best_per_rank(approximate)
+    corner, corner_ms = time_call(lambda: bank.best_per_rank(bank.score_corners(cards, main.CORNER_CONFIRM)), repeat)
+
+    agreement = float(np.mean(np.argmax(exhaustive, axis=1) == np.argmax(pruned, axis=1)))
+    score_delta = float(np.max(np.abs(exhaustive.max(axis=1) - pruned.max(axis=1))))
+    return {
+        "top_k": main.MATCH_TOP_K,
+        "cards": len(cards),
+        "rank_agreement": round(agreement, 4),
+        "max_score_delta": round(score_delta, 6),
+        "within_tolerance": agreement == 1.0 and score_delta <= tolerance,
+        "exhaustive_ms_per_card": round(exhaustive_ms / len(cards), 3),
+        "pruned_ms_per_card": round(pruned_ms / len(cards), 3),
+        "cascade_rank_agreement": round(float(np.mean(np.argmax(exhaustive, axis=1) == np.argmax(cascade, axis=1))), 4),
+        "cascade_templates_per_card": round(float(np.mean(cascade_evaluated)), 2),
+        "cascade_primed_templates_per_card": round(float(np.mean(primed_evaluated)), 2),
+        "cascade_ms_per_card": round(cascade_ms / len(cards), 3),
+        "corner_rank_agreement": round(float(np.mean(np.argmax(exhaustive, axis=1) == np.argmax(corner, axis=1))), 4),
+        "corner_ms_per_card": round(corner_ms / len(cards), 3),
+        "descriptor_rank_agreement": round(float(np.mean(np.argmax(exhaustive, axis=1) == np.argmax(descriptor, axis=1))), 4),
+        "descriptor_ms_per_card": round(descriptor_ms / len(cards), 3),
+        "approximate_rank_agreement": round(float(np.mean(np.argmax(exhaustive, axis=1) == np.argmax(approximate, axis=1))), 4),
+        "approximate_ms_per_card": round(approximate_ms / len(cards), 3),
+    }
+
+
+def score_accuracy(expected, result):
+    """Fraction of hands and of cards recognized exactly (cards compared position by position)"""
+    hands_ok = cards_ok = cards_total = 0
+    for hand, ranks in expected.items():
+        detected = result.get(hand, {}).get("cards", [])
+        hands_ok += detected == ranks
+        cards_total += len(ranks)
+        cards_ok += sum(a == b for a, b in zip(ranks, detected))
+    return {
+        "hands": round(hands_ok / len(expected), 3),
+        "cards": round(cards_ok / cards_total, 3) if cards_total else 1.0,
+    }
+
+
+def benchmark_case(width, height, num_cards, players, repeat, seed, tolerance, clutter=0, tier="full"):
+    scene, expected = create_synthetic_scene(width, height, num_cards, players, seed, clutter)
+    success, buffer = cv2.imencode(".jpg", scene, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not success:
+        raise RuntimeError("Failed to encode synthetic scene")
+    image_data = buffer.tobytes()
+
+    # Warm-up run, also used for the accuracy check
+    result = run_pipeline(image_data, players, main.StageTimings(), tier)
+
+    stage_samples = {}
+    totals = []
+    for _ in range(repeat):
+        timings = main.StageTimings()
+        start = time.perf_counter()
+        run_pipeline(image_data, players, timings, tier)
+        totals.append((time.perf_counter() - start) * 1000)
+        for stage, seconds in timings.items():
+            stage_samples.setdefault(stage, []).append(seconds * 1000)
+
+    return {
+        "resolution": [width, height],
+        "cards": num_cards,
+        "players": players,
+        "clutter": clutter,
+        "input_bytes": len(image_data),
+        "total": summarize(totals),
+        "stages": {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        "alloc_peak_kib": measure_allocations(image_data, players),
+        "accuracy": score_accuracy(expected, result),
+        "pruning": compare_matching(image_data, players, repeat, tolerance),
+        "expected": expected,
+        "detected": {hand: result.get(hand, {}).get("cards", []) for hand in expected},
+    }
+
+
+def check_odds(repeat):
+    """
+    evaluate_hand for every one- and two-card player hand against every dealer upcard, on the
+    precomputed fresh-shoe-minus-upcard tables: hands whose odds are missing or do not sum to 1,
+    and the median cost per hand once the tables are built.
+    """
+    ranks = ["Ace"] + [str(value) for value in range(2, 11)]
+    hands = [[first] for first in ranks] + [[first, second] for i, first in enumerate(ranks) for second in ranks[i:]]
+    main.precompute_odds_tables()
+
+    def evaluate_all():
+        return [(upcard, player, main.evaluate_hand([upcard], player, main.shoe_composition([upcard])))
+                for upcard in ranks for player in hands]
+
+    evaluated, elapsed_ms = time_call(evaluate_all, repeat)
+    failures = [
+        {"dealer": [upcard], "player": player, "odds": odds}
+        for upcard, player, odds in evaluated
+        if odds is None or abs(odds["win"] + odds["push"] + odds["lose"] - 1) > 1e-3
+    ]
+    return {
+        "hands": len(evaluated),
+        "us_per_hand": round(elapsed_ms * 1000 / len(evaluated), 2),
+        "failures": failures,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_resolutions(value):
+    return [tuple(int(v) for v in item.lower().split("x")) for item in value.split(",")]
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",")]
+
+
+def run_benchmark(args):
+    main.get_template_bank()
+
+    odds = check_odds(args.repeat)
+    print(f"odds: {odds['hands']} hands, {odds['us_per_hand']:.1f} us/hand, {len(odds['failures'])} failures")
+
+    cases = []
+    for width, height in args.resolutions:
+        for num_cards in args.cards:
+            for players in args.players:
+                for clutter in args.clutter:
+                    case = benchmark_case(width, height, num_cards, players, args.repeat, args.seed,
+                                          args.score_tolerance, clutter, args.quality_tier)
+                    cases.append(case)
+                    pruning = case["pruning"] or {}
+                    print(f"{width}x{height} cards={num_cards} players={players} clutter={clutter}: "
+                          f"median {case['total']['median_ms']:.1f}ms, "
+                          f"accuracy {case['accuracy']['cards']:.0%}, "
+                          f"pruning agreement {pruning.get('rank_agreement', 1.0):.0%} "
+                          f"({pruning.get('exhaustive_ms_per_card', 0):.1f} -> {pruning.get('pruned_ms_per_card', 0):.1f} ms/card), "
+                          f"cascade agreement {pruning.get('cascade_rank_agreement', 1.0):.0%} "
+                          f"({pruning.get('cascade_templates_per_card', 0):.1f} templates, "
+                          f"{pruning.get('cascade_primed_templates_per_card', 0):.1f} primed, "
+                          f"{pruning.get('cascade_ms_per_card', 0):.2f} ms/card), "
+                          f"corner agreement {pruning.get('corner_rank_agreement', 1.0):.0%} "
+                          f"({pruning.get('corner_ms_per_card', 0):.2f} ms/card), "
+                          f"descriptor agreement {pruning.get('descriptor_rank_agreement', 1.0):.0%} "
+                          f"({pruning.get('descriptor_ms_per_card', 0):.2f} ms/card, approximate "
+                          f"{pruning.get('approximate_rank_agreement', 1.0):.0%} "
+                          f"{pruning.get('approximate_ms_per_card', 0):.2f} ms/card)")
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "match_top_k": main.MATCH_TOP_K,
+            "match_mode": main.MATCH_MODE,
+            "quality_tier": args.quality_tier,
+            "max_image_dimension": main.MAX_IMAGE_DIMENSION,
+            "detection_max_dimension": main.DETECTION_MAX_DIMENSION,
+            "score_tolerance": args.score_tolerance,
+        },
+        "odds": odds,
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(cases)} cases to {args.output}")
+
+    failures = [case for case in cases if case["pruning"] and not case["pruning"]["within_tolerance"]]
+    if failures:
+        print(f"{len(failures)} cases where pruned matching differs from exhaustive matching beyond tolerance")
+        return 1
+    if odds["failures"]:
+        print(f"{len(odds['failures'])} hands without valid odds")
+        return 1
+    return 0
+
+
+def case_key(case):
+    return (tuple(case["resolution"]), case["cards"], case["players"], case.get("clutter", 0))
+
+
+def compare_reports(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f"before: {before['meta'].get('revision')}  after: {after['meta'].get('revision')}")
+    before_cases = {case_key(case): case for case in before["cases"]}
+    for case in after["cases"]:
+        old = before_cases.get(case_key(case))
+        if old is None:
+            continue
+        width, height = case["resolution"]
+        old_ms, new_ms = old["total"]["median_ms"], case["total"]["median_ms"]
+        print(f"{width}x{height} cards={case['cards']} players={case['players']} clutter={case.get('clutter', 0)}: "
+              f"{old_ms:.1f}ms -> {new_ms:.1f}ms ({old_ms / new_ms:.2f}x), "
+              f"accuracy {old['accuracy']['cards']:.0%} -> {case['accuracy']['cards']:.0%}")
+        for stage, stats in case["stages"].items():
+            if stage in old["stages"]:
+                print(f"    {stage:10s} {old['stages'][stage]['median_ms']:8.2f}ms -> {stats['median_ms']:8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the card recognition pipeline offline")
+    parser.add_argument("--resolutions", type=parse_resolutions, default=parse_resolutions("800x600,1920x1440,4032x3024"))
+    parser.add_argument("--cards", type=parse_ints, default=[3, 6])
+    parser.add_argument("--players", type=parse_ints, default=[1, 2])
+    parser.add_argument("--clutter", type=parse_ints, default=[0], help="chips/text snippets drawn on the felt")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--top-k", type=int, help="override BJV_MATCH_TOP_K for the pruning check")
+    parser.add_argument("--match-mode", choices=["full", "cascade", "corner", "descriptor"], help="override BJV_MATCH_MODE for the pipeline runs")
+    parser.add_argument("--quality-tier", choices=list(main.QUALITY_TIERS), default="full",
+                        help="run the pipeline at this load-shedding quality tier")
+    parser.add_argument("--score-tolerance", type=float, default=1e-4,
+                        help="max allowed best-score difference between pruned and exhaustive matching")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.top_k is not None:
+        main.MATCH_TOP_K = args.top_k
+    if args.match_mode is not None:
+        main.MATCH_MODE = args.match_mode
+
+    if args.compare:
+        compare_reports(*args.compare)
+    else:
+        sys.exit(run_benchmark(args))